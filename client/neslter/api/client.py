@@ -1,5 +1,6 @@
 import os
-from io import StringIO
+from importlib.util import find_spec
+from io import BytesIO, StringIO
 from getpass import getpass
 
 import dotenv
@@ -22,7 +23,24 @@ def post_csv(url, csv_file, csv_filename=None, headers={}, params={}):
     return response
 
 
-def parse_csv_response(response):
+def preferred_format():
+    # binary formats keep column types and are much faster to decode,
+    # but need pyarrow. fall back to CSV without it
+    return 'arrow' if find_spec('pyarrow') is not None else 'csv'
+
+
+def parse_response(response):
+    """decode a DataFrame response according to its content type"""
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type == 'application/vnd.apache.arrow.stream':
+        import pyarrow as pa
+        # reads straight out of the response body, without copying it
+        return pa.ipc.open_stream(pa.py_buffer(response.content)).read_pandas()
+    if content_type == 'application/vnd.apache.arrow.file':
+        return pd.read_feather(BytesIO(response.content))
+    if content_type == 'application/vnd.apache.parquet':
+        return pd.read_parquet(BytesIO(response.content))
     df = pd.read_csv(StringIO(response.text))
     return df
 
@@ -35,11 +53,16 @@ def construct_api_url(suffix):
     return url
 
 
-def parse_ctd(ctd_file, file_type):
+def parse_ctd(ctd_file, file_type, params=None):
     suffix = f'/parse-ctd-{file_type}/'
     url = construct_api_url(suffix)
-    response = post_csv(url, ctd_file, csv_filename=f'{file_type}_file')
-    return parse_csv_response(response)
+    if file_type == 'hdr': # header fields come back as JSON
+        response = post_csv(url, ctd_file, csv_filename=f'{file_type}_file')
+        response.raise_for_status()
+        return response.json()
+    params = dict(params or {}, format=preferred_format())
+    response = post_csv(url, ctd_file, csv_filename=f'{file_type}_file', params=params)
+    return parse_response(response)
 
 
 def obtain_auth_token():
@@ -72,21 +95,45 @@ class Client(object):
     def parse_btl(self, btl_file):
         return parse_ctd(btl_file, 'btl')
     
-    def parse_asc(self, asc_file):
-        return parse_ctd(asc_file, 'asc')
+    def parse_asc(self, asc_file, depth=False, latitude=None):
+        # with depth, a depsm column is derived from pressure, at the given
+        # latitude or else the file's own latitude column
+        params = {'depth': 'true'} if depth else {}
+        if latitude is not None:
+            params['latitude'] = latitude
+        return parse_ctd(asc_file, 'asc', params)
     
     def station_list(self, timestamp=None):
         suffix = '/station-list'
         url = construct_api_url(suffix)
         params = {'timestamp': timestamp} if timestamp else {}
+        params['format'] = preferred_format()
         response = requests.get(url, params=params)
-        return parse_csv_response(response)
+        return parse_response(response)
+
+    def nearest_stations(self, points, k=1):
+        """points is a DataFrame or list of dicts with latitude, longitude and
+        (optionally) timestamp. returns the k nearest stations for each point"""
+        if isinstance(points, pd.DataFrame):
+            points = points.copy()
+            if 'timestamp' in points.columns and pd.api.types.is_datetime64_any_dtype(points['timestamp']):
+                # Timestamps can't be sent as JSON, so send them as ISO 8601 strings
+                # in UTC. missing ones are sent as null, and the server uses the current time
+                times = points['timestamp']
+                if times.dt.tz is not None:
+                    times = times.dt.tz_convert('UTC')
+                points['timestamp'] = times.dt.strftime('%Y-%m-%dT%H:%M:%S').astype(object).where(times.notnull(), None)
+            points = points.to_dict(orient='records')
+        url = construct_api_url('/nearest-station/')
+        response = requests.post(url, json=points, params={'k': k})
+        response.raise_for_status()
+        return response.json()
 
     def add_nearest_stations(self, csv_file, timestamp_column=None, latitude_column=None, longitude_column=None):
         # TODO accept dataframe as input in addition to CSV file
         suffix = '/add-nearest-stations/'
         url = construct_api_url(suffix)
-        params = {}
+        params = {'format': preferred_format()}
         if timestamp_column is not None:
             params['timestamp_column'] = timestamp_column
         if latitude_column is not None:
@@ -94,4 +141,4 @@ class Client(object):
         if longitude_column is not None:
             params['longitude_column'] = longitude_column
         response = post_csv(url, csv_file, csv_filename='csv_file', params=params)
-        return parse_csv_response(response)
+        return parse_response(response)
@@ -0,0 +1,111 @@
+# vectorized geodesic utilities for nearest-station lookups
+
+import numpy as np
+import pandas as pd
+
+# mean radius of the WGS84 ellipsoid, which is the sphere PostGIS uses
+# for ST_DistanceSphere (what Django's Distance computes for lon/lat points)
+EARTH_RADIUS_M = 6371008.8
+
+# maximum number of points x locations evaluated at once
+DEFAULT_CHUNK_SIZE = 4096
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """great-circle distance in meters between points given in decimal degrees.
+    arguments are broadcast against each other"""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(a, dtype=float)) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def to_unit_vectors(latitudes, longitudes):
+    """convert decimal degree coordinates to 3D unit vectors. euclidean (chord) distance
+    between unit vectors is monotonic in great-circle distance, so they can be put in
+    an ordinary KD-tree"""
+    lat = np.radians(np.asarray(latitudes, dtype=float))
+    lon = np.radians(np.asarray(longitudes, dtype=float))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def to_utc_datetimes(timestamps, errors='raise'):
+    """convert an array-like of timestamps or ISO 8601 strings to a UTC datetime Series.
+    naive timestamps are assumed to be UTC"""
+    if isinstance(timestamps, pd.Series) and pd.api.types.is_datetime64_any_dtype(timestamps):
+        times = timestamps.dt.tz_localize('UTC') if timestamps.dt.tz is None else timestamps.dt.tz_convert('UTC')
+    else:
+        times = pd.to_datetime(pd.Series(np.asarray(timestamps, dtype=object)), utc=True, format='ISO8601', errors=errors)
+    return times.astype('datetime64[ns, UTC]')
+
+
+def to_utc_nanoseconds(timestamps):
+    """convert an array-like of timestamps to int64 nanoseconds since the epoch (UTC)"""
+    return to_utc_datetimes(timestamps).to_numpy(dtype='int64')
+
+
+def validate_points(latitudes, longitudes, times):
+    """check latitude, longitude and time columns for out of range or missing values,
+    raising ValueError for the first offending value. returns float64 lat/lon arrays
+    and int64 nanosecond times"""
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+
+    bad = ~((latitudes >= -90) & (latitudes <= 90))
+    if bad.any():
+        raise ValueError(f'Invalid latitude value: {latitudes[bad.argmax()]}')
+    bad = ~((longitudes >= -180) & (longitudes <= 180))
+    if bad.any():
+        raise ValueError(f'Invalid longitude value: {longitudes[bad.argmax()]}')
+
+    times = pd.Series(times).reset_index(drop=True)
+    if times.isnull().any():
+        raise ValueError('Invalid timestamp value: null')
+    parsed = to_utc_datetimes(times, errors='coerce')
+    bad = parsed.isnull().to_numpy()
+    if bad.any():
+        raise ValueError(f'Invalid timestamp value: {times[bad.argmax()]}')
+
+    return latitudes, longitudes, parsed.to_numpy(dtype='int64')
+
+
+def validity_nanoseconds(locations):
+    """start and end times of a location DataFrame as int64 ns. open-ended
+    locations (null end_time) are given the largest representable end time"""
+    start = to_utc_nanoseconds(locations['start_time'])
+    open_ended = locations['end_time'].isnull().to_numpy()
+    end = to_utc_nanoseconds(locations['end_time'].fillna(locations['start_time']))
+    return start, np.where(open_ended, np.iinfo(np.int64).max, end)
+
+
+def nearest_locations(latitudes, longitudes, times, locations, chunk_size=DEFAULT_CHUNK_SIZE):
+    """find the nearest time-valid location for every point in one vectorized pass.
+
+    latitudes, longitudes and times (int64 ns) describe the query points. locations
+    is a DataFrame as returned by Station.location_frame. a location is valid at time t
+    if start_time <= t and (end_time >= t or end_time is null), as in Station.get_location.
+
+    returns (ix, distance_m) where ix is the row position in locations of the nearest
+    valid location (-1 if there is none) and distance_m is the distance to it in meters"""
+    n = len(latitudes)
+    ix = np.full(n, -1, dtype=np.int64)
+    distance_m = np.full(n, np.nan)
+
+    if n == 0 or locations.empty:
+        return ix, distance_m
+
+    loc_lat = locations['latitude'].to_numpy(dtype=float)
+    loc_lon = locations['longitude'].to_numpy(dtype=float)
+    loc_start, loc_end = validity_nanoseconds(locations)
+
+    for start in range(0, n, chunk_size):
+        end = min(start + chunk_size, n)
+        t = times[start:end, np.newaxis]
+        valid = (loc_start <= t) & (loc_end >= t)
+        d = haversine_m(latitudes[start:end, np.newaxis], longitudes[start:end, np.newaxis], loc_lat, loc_lon)
+        d = np.where(valid, d, np.inf)
+        nearest = d.argmin(axis=1)
+        found = valid.any(axis=1)
+        ix[start:end] = np.where(found, nearest, -1)
+        distance_m[start:end] = np.where(found, d[np.arange(end - start), nearest], np.nan)
+
+    return ix, distance_m
@@ -0,0 +1,312 @@
+# in-process spatial index of station locations, partitioned by validity epoch
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from django.conf import settings
+from django.db.models import F
+
+from api.geo import haversine_m, to_unit_vectors, to_utc_nanoseconds, validity_nanoseconds
+from api.instrumentation import stage
+from api.metrics import count_cache_lookups
+
+
+def location_table_version():
+    """the version of the location table. it is kept in the database (see
+    LocationTableVersion), so writes made by any process, such as a management
+    command, are seen by every server process"""
+    from api.models import LocationTableVersion
+    return LocationTableVersion.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+
+def invalidate_location_index():
+    """mark the location table as changed by bumping its version in the current
+    transaction (if any), so the new version is committed along with the change
+    and no process sees one without the other"""
+    from api.models import LocationTableVersion
+    if not LocationTableVersion.objects.filter(pk=1).update(version=F('version') + 1):
+        LocationTableVersion.objects.get_or_create(pk=1, defaults={ 'version': 1 })
+
+
+class LocationIndex(object):
+    """nearest-location index over a set of station locations.
+
+    the timeline is split into epochs by the start and end times of all locations:
+    every boundary time is its own epoch, as is every open interval between consecutive
+    boundaries. the set of valid locations is constant within an epoch, so each
+    epoch gets a KD-tree (built on first use) over the unit vectors of its locations"""
+
+    def __init__(self, locations):
+        # locations is a DataFrame as returned by Station.location_frame
+        self.locations = locations.reset_index(drop=True)
+        self._latitudes = self.locations['latitude'].to_numpy(dtype=float)
+        self._longitudes = self.locations['longitude'].to_numpy(dtype=float)
+        self._xyz = to_unit_vectors(self._latitudes, self._longitudes)
+        self._start, self._end = validity_nanoseconds(self.locations)
+        finite_end = self._end[self._end != np.iinfo(np.int64).max]
+        self.boundaries = np.unique(np.concatenate([self._start, finite_end]))
+        self._trees = {}
+        self.version = None
+
+    def __len__(self):
+        return len(self.locations)
+
+    def epochs(self, times):
+        """epoch keys of an array of int64 ns times. key 2i+1 is the boundary time
+        boundaries[i], key 2i is the open interval just before it"""
+        times = np.asarray(times, dtype=np.int64)
+        b = self.boundaries
+        pos = np.searchsorted(b, times, side='left')
+        if len(b) == 0:
+            return 2 * pos
+        on_boundary = (pos < len(b)) & (b[np.minimum(pos, len(b) - 1)] == times)
+        return 2 * pos + on_boundary
+
+    def epoch_bounds(self, key):
+        """(first, last) int64 ns times covered by an epoch. None means unbounded"""
+        pos, on_boundary = divmod(int(key), 2)
+        b = self.boundaries
+        if on_boundary:
+            return int(b[pos]), int(b[pos])
+        first = int(b[pos - 1]) + 1 if pos > 0 else None
+        last = int(b[pos]) - 1 if pos < len(b) else None
+        return first, last
+
+    def _valid(self, key):
+        pos, on_boundary = divmod(int(key), 2)
+        if on_boundary:
+            t = self.boundaries[pos]
+        elif pos == 0: # before the first start time, nothing is valid
+            return np.zeros(len(self), dtype=bool)
+        else: # validity is constant over the open interval
+            t = self.boundaries[pos - 1] + 1
+        return (self._start <= t) & (self._end >= t)
+
+    def _epoch_tree(self, key):
+        try:
+            return self._trees[key]
+        except KeyError:
+            pass
+        positions = np.flatnonzero(self._valid(key))
+        tree = cKDTree(self._xyz[positions]) if len(positions) else None
+        self._trees[key] = positions, tree
+        return positions, tree
+
+    def nearest(self, latitudes, longitudes, times, k=1):
+        """the k nearest valid locations of each point (int64 ns times).
+
+        returns (ix, distance_m): ix holds row positions in self.locations and is
+        -1 where there are fewer than k valid locations (distance is then nan).
+        both arrays have shape (n,) when k == 1 and (n, k) otherwise"""
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        n = len(latitudes)
+        ix = np.full((n, k), -1, dtype=np.int64)
+        distance_m = np.full((n, k), np.nan)
+
+        keys = self.epochs(times)
+        xyz = to_unit_vectors(latitudes, longitudes)
+        for key in np.unique(keys):
+            positions, tree = self._epoch_tree(key)
+            if tree is None:
+                continue
+            rows = np.flatnonzero(keys == key)
+            _, nearest = tree.query(xyz[rows], k=min(k, len(positions)))
+            nearest = nearest.reshape(len(rows), -1)
+            ix[rows, :nearest.shape[1]] = positions[nearest]
+
+        # exact distances for the neighbors found
+        found = ix >= 0
+        rows, cols = np.nonzero(found)
+        distance_m[rows, cols] = haversine_m(latitudes[rows], longitudes[rows],
+            self._latitudes[ix[rows, cols]], self._longitudes[ix[rows, cols]])
+
+        if k == 1:
+            return ix[:, 0], distance_m[:, 0]
+        return ix, distance_m
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def location_index():
+    """the LocationIndex for the current contents of the location table,
+    rebuilt (with one query) only when the table version has changed"""
+    global _index
+    from api.models import Station
+
+    version = location_table_version()
+    with _index_lock:
+        if _index is None or _index.version != version:
+            with stage('location_index') as s:
+                _index = LocationIndex(Station.location_frame())
+                s.rows = len(_index)
+            _index.version = version
+        return _index
+
+
+def epoch_cache_key(prefix, timestamp):
+    """a cache key for results that only depend on which locations are valid at
+    timestamp: it changes when timestamp crosses a location interval boundary or
+    when the location table is written"""
+    index = location_index()
+    epoch = index.epochs([to_utc_nanoseconds([timestamp])[0]])[0]
+    return f'{prefix}:{index.version}:{epoch}'
+
+
+# defaults for settings.NESLTER_NEAREST_MEMO_SIZE (entries per kind) and
+# settings.NESLTER_NEAREST_MEMO_QUANTUM (degrees)
+DEFAULT_MEMO_SIZE = 100000
+DEFAULT_MEMO_QUANTUM = 1e-5
+
+
+class NearestMemo(object):
+    """LRU memo of nearest-location results, keyed by the validity epoch of
+    the query time and the query position rounded to a multiple of quantum
+    degrees, with at most maxsize entries for each kind of result. repeated
+    positions (every bottle of a cast, say) are looked up once. entries are
+    dropped as soon as the location table version changes"""
+
+    def __init__(self, maxsize=DEFAULT_MEMO_SIZE, quantum=DEFAULT_MEMO_QUANTUM):
+        self.maxsize = maxsize
+        self.quantum = quantum
+        self.hits = 0
+        self.misses = 0
+        self._entries = {} # an OrderedDict of entries per kind
+        self._version = None
+        self._lock = threading.Lock()
+
+    def key_arrays(self, index, latitudes, longitudes, times):
+        """the parts of the memo keys of arrays of points (int64 ns times):
+        epoch, quantized latitude and quantized longitude arrays"""
+        epochs = index.epochs(times)
+        qlat = np.round(np.asarray(latitudes, dtype=float) / self.quantum).astype(np.int64)
+        qlon = np.round(np.asarray(longitudes, dtype=float) / self.quantum).astype(np.int64)
+        return epochs, qlat, qlon
+
+    def keys(self, index, latitudes, longitudes, times):
+        """memo keys of arrays of points, as (epoch, latitude, longitude) tuples"""
+        return list(zip(*(a.tolist() for a in self.key_arrays(index, latitudes, longitudes, times))))
+
+    def _check_version(self, version):
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def get(self, kind, version, key):
+        """(True, value) for a memoized result, or (False, None)"""
+        values, misses = self.get_many(kind, version, [key])
+        return (False, None) if misses else (True, values[0])
+
+    def get_many(self, kind, version, keys):
+        """look up a list of keys. returns a list of values (None for misses)
+        and the positions of the keys that missed"""
+        values, misses = [None] * len(keys), []
+        with self._lock:
+            self._check_version(version)
+            entries = self._entries.setdefault(kind, OrderedDict())
+            for i, key in enumerate(keys):
+                value = entries.get(key, entries) # entries as the not found marker
+                if value is entries:
+                    misses.append(i)
+                else:
+                    entries.move_to_end(key)
+                    values[i] = value
+            self.misses += len(misses)
+            self.hits += len(values) - len(misses)
+        count_cache_lookups('nearest_memo', hits=len(values) - len(misses), misses=len(misses))
+        return values, misses
+
+    def put(self, kind, version, key, value):
+        self.put_many(kind, version, [key], [value])
+
+    def put_many(self, kind, version, keys, values):
+        with self._lock:
+            self._check_version(version)
+            entries = self._entries.setdefault(kind, OrderedDict())
+            # only the most recent maxsize entries would survive anyway
+            for key, value in list(zip(keys, values))[-self.maxsize:]:
+                entries[key] = value
+                entries.move_to_end(key)
+            while len(entries) > self.maxsize:
+                entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': sum(len(entries) for entries in self._entries.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else None,
+        }
+
+
+_memo = None
+_memo_lock = threading.Lock()
+
+
+def nearest_memo():
+    """the NearestMemo shared by all requests in this process"""
+    global _memo
+    with _memo_lock:
+        if _memo is None:
+            _memo = NearestMemo(getattr(settings, 'NESLTER_NEAREST_MEMO_SIZE', DEFAULT_MEMO_SIZE),
+                                getattr(settings, 'NESLTER_NEAREST_MEMO_QUANTUM', DEFAULT_MEMO_QUANTUM))
+        return _memo
+
+
+def assign_nearest_stations(index, latitudes, longitudes, times, memo=None):
+    """the name of the nearest valid station (None if there is none) and the
+    distance to it in meters for arrays of points (int64 ns times).
+
+    with a NearestMemo, each distinct (epoch, quantized position) is looked up
+    once, in the memo or else in the index, since rows often repeat a position;
+    distances are always exact for each point"""
+    station_names = index.locations['station'].to_numpy(dtype=object)
+    if memo is None:
+        ix, distance_m = index.nearest(latitudes, longitudes, times)
+        found = ix >= 0
+        stations = np.full(len(ix), None, dtype=object)
+        stations[found] = station_names[ix[found]]
+        return stations, distance_m
+
+    parts = memo.key_arrays(index, latitudes, longitudes, times)
+    codes = pd.DataFrame(dict(enumerate(parts))).groupby([0, 1, 2], sort=False).ngroup().to_numpy()
+    # first row of each distinct key
+    first = np.zeros(codes.max() + 1 if len(codes) else 0, dtype=np.int64)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    keys = list(zip(*(a[first].tolist() for a in parts)))
+
+    stations = np.full(len(keys), None, dtype=object)
+    station_lats = np.full(len(keys), np.nan)
+    station_lons = np.full(len(keys), np.nan)
+    values, misses = memo.get_many('station', index.version, keys)
+    for i, value in enumerate(values):
+        if value is not None:
+            stations[i], station_lats[i], station_lons[i] = value
+
+    if misses:
+        misses = np.asarray(misses)
+        rows = first[misses]
+        ix, _ = index.nearest(latitudes[rows], longitudes[rows], times[rows])
+        found = ix >= 0
+        hits = misses[found]
+        stations[hits] = station_names[ix[found]]
+        station_lats[hits] = index.locations['latitude'].to_numpy(dtype=float)[ix[found]]
+        station_lons[hits] = index.locations['longitude'].to_numpy(dtype=float)[ix[found]]
+        values = list(zip(stations[misses], station_lats[misses].tolist(), station_lons[misses].tolist()))
+        for j in np.flatnonzero(~found): # no valid location
+            values[j] = None
+        memo.put_many('station', index.version, [keys[i] for i in misses], values)
+
+    distance_m = haversine_m(latitudes, longitudes, station_lats[codes], station_lons[codes])
+    return stations[codes], distance_m
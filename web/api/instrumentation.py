@@ -0,0 +1,138 @@
+# per-request timing of the stages of a request (reading input, validation,
+# nearest-station lookups, parsing, rendering) and of its database queries.
+#
+# api.middleware.TimingMiddleware makes a Timings active for each request;
+# stage() and friends record into the active Timings, and cost next to nothing
+# when there is none (in scripts, management commands and jobs)
+
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar('api.instrumentation.timings', default=None)
+
+
+def current_timings():
+    """the active Timings, or None"""
+    return _current.get()
+
+
+class Timings(object):
+    """wall time, number of calls and rows processed per named stage, plus the
+    number and total time of database queries"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {} # name -> [seconds, count, rows], in the order first seen
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def add(self, name, seconds, rows=None):
+        entry = self.stages.setdefault(name, [0.0, 0, None])
+        entry[0] += seconds
+        entry[1] += 1
+        if rows is not None:
+            entry[2] = (entry[2] or 0) + rows
+
+    def add_query(self, seconds):
+        self.queries += 1
+        self.query_seconds += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    @contextmanager
+    def activated(self):
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def server_timing(self, total=None):
+        """the stages as a Server-Timing header value (durations in ms)"""
+        metrics = []
+        for name, (seconds, count, rows) in self.stages.items():
+            metric = f'{name};dur={seconds * 1000:.1f}'
+            if rows is not None:
+                metric += f';desc="{rows} rows"'
+            metrics.append(metric)
+        if self.queries:
+            metrics.append(f'db;dur={self.query_seconds * 1000:.1f};desc="{self.queries} queries"')
+        if total is not None:
+            metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'db_queries': self.queries,
+            'db_ms': round(self.query_seconds * 1000, 3),
+            'stages': {
+                name: { 'ms': round(seconds * 1000, 3), 'count': count, 'rows': rows }
+                for name, (seconds, count, rows) in self.stages.items()
+            },
+        }
+
+
+class _Stage(object):
+    __slots__ = ('name', 'rows', '_timings', '_start')
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+
+    def __enter__(self):
+        self._timings = _current.get()
+        if self._timings is not None:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self._timings is not None:
+            self._timings.add(self.name, time.perf_counter() - self._start, self.rows)
+
+
+def stage(name, rows=None):
+    """time a block as a stage of the current request. rows processed can be
+    given up front or set on the returned object inside the block:
+
+        with stage('read_csv') as s:
+            df = pd.read_csv(f)
+            s.rows = len(df)
+    """
+    return _Stage(name, rows)
+
+
+def timed(name, rows=None):
+    """decorator timing each call of a function as a stage. rows, if given, is
+    called on the function's result to count the rows it processed"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if _current.get() is None:
+                return fn(*args, **kw)
+            with stage(name) as s:
+                result = fn(*args, **kw)
+                if rows is not None:
+                    s.rows = rows(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def timed_chunks(name, chunks):
+    """wrap an iterator of DataFrames so that producing each one is timed as a
+    stage. chunks are usually produced while a response streams, after the view
+    has returned, so the stage ends up in the log line but not the headers"""
+    chunks = iter(chunks)
+    while True:
+        start = time.perf_counter()
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        timings = _current.get()
+        if timings is not None:
+            timings.add(name, time.perf_counter() - start, len(chunk))
+        yield chunk
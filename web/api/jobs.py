@@ -0,0 +1,341 @@
+# asynchronous jobs for large enrichment, parsing and compiling requests.
+#
+# each job is a directory under settings.NESLTER_JOBS_DIR holding the uploaded
+# input (if any), a status.json file and, once finished, result.parquet. jobs run in a
+# local pool of worker processes, so no broker is needed; the status file on
+# disk is the only shared state, which lets any server process report on any job
+
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+
+from django.conf import settings
+
+from api.responses import arrow_chunks
+
+STATUS_FILE = 'status.json'
+RESULT_FILE = 'result.parquet'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+FAILED = 'failed'
+
+JOB_ID_REGEX = re.compile(r'^[0-9a-f]{32}$')
+
+
+class JobNotFound(LookupError):
+    pass
+
+
+def jobs_dir():
+    return settings.NESLTER_JOBS_DIR
+
+
+def job_dir(job_id):
+    if not JOB_ID_REGEX.match(str(job_id)):
+        raise JobNotFound(job_id)
+    return os.path.join(jobs_dir(), job_id)
+
+
+def _write_status(path, status):
+    # write then rename, so readers never see a partial file
+    tmp_path = os.path.join(path, STATUS_FILE + '.tmp')
+    with open(tmp_path, 'w') as fout:
+        json.dump(status, fout)
+    os.replace(tmp_path, os.path.join(path, STATUS_FILE))
+
+
+def _read_status(path):
+    with open(os.path.join(path, STATUS_FILE)) as fin:
+        return json.load(fin)
+
+
+def _update_status(path, **kw):
+    status = _read_status(path)
+    status.update(kw)
+    status['updated'] = time.time()
+    _write_status(path, status)
+    return status
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # someone else's process
+        return True
+    return True
+
+
+def _orphaned(status):
+    # a queued or running job belongs to the pool of the server process that
+    # submitted it, and will never finish if that process has exited
+    return (status['status'] in (QUEUED, RUNNING) and status.get('pid') is not None
+            and status.get('host') == socket.gethostname() and not _process_alive(status['pid']))
+
+
+def _fail_orphaned(path):
+    return _update_status(path, status=FAILED, finished=time.time(),
+                          error='The server process running the job exited')
+
+
+def fail_orphaned_jobs():
+    """mark queued and running jobs whose server process has exited as failed.
+    returns the ids of the jobs failed"""
+    failed = []
+    if not os.path.isdir(jobs_dir()):
+        return failed
+    for job_id in os.listdir(jobs_dir()):
+        if not JOB_ID_REGEX.match(job_id):
+            continue
+        path = os.path.join(jobs_dir(), job_id)
+        try:
+            status = _read_status(path)
+            if _orphaned(status):
+                _fail_orphaned(path)
+                failed.append(job_id)
+        except (OSError, ValueError): # removed or being written
+            continue
+    return failed
+
+
+def job_status(job_id, ttl=None):
+    """the status of a job as a dict. raises JobNotFound for unknown (or expired) jobs.
+    expired jobs are deleted, and orphaned ones (see fail_orphaned_jobs) failed, here"""
+    path = job_dir(job_id)
+    try:
+        status = _read_status(path)
+    except FileNotFoundError:
+        raise JobNotFound(job_id)
+    ttl = settings.NESLTER_JOB_TTL if ttl is None else ttl
+    if time.time() - status.get('updated', 0) > ttl:
+        shutil.rmtree(path, ignore_errors=True)
+        raise JobNotFound(job_id)
+    if _orphaned(status):
+        status = _fail_orphaned(path)
+    return status
+
+
+def result_path(job_id):
+    """path of the result of a finished job"""
+    status = job_status(job_id)
+    if status['status'] != FINISHED:
+        raise ValueError(f'Job {job_id} is {status["status"]}')
+    return os.path.join(job_dir(job_id), RESULT_FILE)
+
+
+def expire_jobs(ttl=None, now=None):
+    """delete jobs last updated more than ttl seconds ago. returns the ids removed"""
+    ttl = settings.NESLTER_JOB_TTL if ttl is None else ttl
+    now = time.time() if now is None else now
+    removed = []
+    if not os.path.isdir(jobs_dir()):
+        return removed
+    for job_id in os.listdir(jobs_dir()):
+        if not JOB_ID_REGEX.match(job_id):
+            continue
+        path = os.path.join(jobs_dir(), job_id)
+        try:
+            updated = _read_status(path).get('updated', 0)
+        except (OSError, ValueError): # unreadable, so go by the directory
+            updated = os.path.getmtime(path)
+        if now - updated > ttl:
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(job_id)
+    return removed
+
+
+# job functions. each reads the input file (None for jobs without one) and
+# returns a DataFrame, or an iterable of DataFrames, and may report progress
+# through the callback
+
+def _add_nearest_stations(input_path, params, progress):
+    import pandas as pd
+    from api.workflows import add_nearest_station
+
+    progress(stage='reading')
+    input_df = pd.read_csv(input_path)
+    progress(stage='enriching', rows=len(input_df))
+    return add_nearest_station(input_df,
+                               timestamp_column=params.get('timestamp_column'),
+                               latitude_column=params.get('latitude_column'),
+                               longitude_column=params.get('longitude_column'))
+
+
+def _parse_btl(input_path, params, progress):
+    from api.parsers.ctd.btl import BtlFile
+
+    progress(stage='parsing')
+    btl = BtlFile(path=input_path, parse=True)
+    df = btl.to_dataframe()
+    progress(rows=len(df), memory_bytes=btl.memory_report()['total'])
+    return df
+
+
+def _parse_asc(input_path, params, progress):
+    from api.parsers.ctd.asc import parse_asc
+    from api.parsers.ctd.common import memory_report
+
+    latitude = params.get('latitude')
+    chunks = parse_asc(input_path, infer_delimiter=True,
+                       latitude=None if latitude is None else float(latitude),
+                       depth=params.get('depth', '').lower() in ('1', 'true'),
+                       chunksize=params.get('chunksize', 50000))
+    rows, memory_bytes = 0, 0
+    progress(stage='parsing', rows=rows)
+    for chunk in chunks:
+        rows += len(chunk)
+        memory_bytes += memory_report(chunk)['total']
+        progress(rows=rows, memory_bytes=memory_bytes)
+        yield chunk
+
+
+def _compile_cruise(input_path, params, progress):
+    from api.parsers.ctd.compile import compile_cruise
+
+    # the directory is relative to the data volume, and was checked on submission
+    cruise_dir = os.path.join(os.path.realpath(settings.NESLTER_DATA_DIR), params['directory'])
+    progress(stage='compiling')
+    compiled = compile_cruise(cruise_dir, cache=settings.NESLTER_CTD_CACHE_DIR or False)
+    output = params.get('output', 'bottles')
+    df = getattr(compiled, output)
+    if output == 'timings': # don't expose server paths
+        df = df.assign(path=df['path'].map(os.path.basename))
+    return df
+
+
+JOB_KINDS = {
+    'add-nearest-stations': _add_nearest_stations,
+    'parse-ctd-btl': _parse_btl,
+    'parse-ctd-asc': _parse_asc,
+    'compile-cruise': _compile_cruise,
+}
+
+
+def run_job(job_id):
+    """run a queued job to completion, recording the outcome in its status file"""
+    import django.db
+
+    path = job_dir(job_id)
+    status = _update_status(path, status=RUNNING, started=time.time())
+
+    def progress(**kw):
+        _update_status(path, **kw)
+
+    django.db.close_old_connections()
+    try:
+        input_path = os.path.join(path, status['input']) if status['input'] else None
+        frames = JOB_KINDS[status['kind']](input_path, status['params'], progress)
+        tmp_path = os.path.join(path, RESULT_FILE + '.tmp')
+        with open(tmp_path, 'wb') as fout:
+            for chunk in arrow_chunks(frames, 'parquet'):
+                fout.write(chunk)
+        os.replace(tmp_path, os.path.join(path, RESULT_FILE))
+        _update_status(path, status=FINISHED, finished=time.time())
+    except Exception as e:
+        _update_status(path, status=FAILED, finished=time.time(), error=str(e))
+    finally:
+        django.db.close_old_connections()
+
+
+def _init_worker():
+    # workers are spawned, not forked, so they need their own Django setup
+    # (and their own database connections)
+    import django
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+    django.setup()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # jobs left behind by an earlier server process will never finish
+            fail_orphaned_jobs()
+            _executor = ProcessPoolExecutor(max_workers=settings.NESLTER_JOB_WORKERS,
+                                            mp_context=get_context('spawn'),
+                                            initializer=_init_worker)
+        return _executor
+
+
+def _discard_executor(pool):
+    # a broken pool runs nothing more, so the next job gets a new one
+    global _executor
+    with _executor_lock:
+        if _executor is pool:
+            _executor = None
+
+
+def _job_done(job_id, pool, future):
+    # run_job records its own failures; this catches the ones it can't,
+    # such as a worker process dying
+    try:
+        future.result()
+        return
+    except BrokenProcessPool as e:
+        _discard_executor(pool)
+        error = e
+    except Exception as e:
+        error = e
+    try:
+        _update_status(job_dir(job_id), status=FAILED, finished=time.time(), error=repr(error))
+    except OSError:
+        pass
+
+
+def submit_job(kind, input_file=None, params=None, owner=None):
+    """queue a job of the given kind (a key of JOB_KINDS) on an uploaded file,
+    if it takes one. returns the job's initial status"""
+    if kind not in JOB_KINDS:
+        raise ValueError(f'Unknown job type: {kind}')
+    expire_jobs()
+
+    job_id = uuid.uuid4().hex
+    path = job_dir(job_id)
+    os.makedirs(path)
+
+    input_name = None
+    if input_file is not None:
+        input_name = 'input' + os.path.splitext(getattr(input_file, 'name', '') or '')[1].lower()
+        with open(os.path.join(path, input_name), 'wb') as fout:
+            for chunk in input_file.chunks():
+                fout.write(chunk)
+
+    now = time.time()
+    status = {
+        'id': job_id,
+        'kind': kind,
+        'status': QUEUED,
+        'params': params or {},
+        'input': input_name,
+        'owner': owner,
+        'host': socket.gethostname(), # the server process whose pool runs the job
+        'pid': os.getpid(),
+        'created': now,
+        'updated': now,
+    }
+    _write_status(path, status)
+
+    pool = executor()
+    try:
+        future = pool.submit(run_job, job_id)
+    except BrokenProcessPool: # broke after its last job finished
+        _discard_executor(pool)
+        pool = executor()
+        future = pool.submit(run_job, job_id)
+    future.add_done_callback(lambda f: _job_done(job_id, pool, f))
+    return status
@@ -0,0 +1,51 @@
+# Compile the CTD files of a cruise into a bottle summary and cast index
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.parsers.ctd.compile import compile_cruise
+
+
+class Command(BaseCommand):
+    help = 'Parse all .hdr, .btl and .asc files in a cruise directory and write bottles.csv, casts.csv and timings.csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=str, help='directory containing the CTD files of a cruise')
+        parser.add_argument('--output', type=str, default='.', help='directory to write the compiled files to')
+        parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: one per CPU)')
+        parser.add_argument('--asc', action='store_true', default=False,
+                            help='also write each parsed ASC file to the output directory as parquet')
+        parser.add_argument('--compact', action='store_true', default=False,
+                            help='downcast parsed columns to smaller types to reduce memory use')
+        parser.add_argument('--no-cache', action='store_true', default=False,
+                            help='parse every file, rather than reusing unchanged files from the parse cache')
+        parser.add_argument('--cache-dir', type=str, default=None,
+                            help='directory of the parse cache (default: .ctd_parse_cache in the cruise directory)')
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['directory']):
+            raise CommandError(f"cannot find directory {options['directory']}")
+        output = options['output']
+        os.makedirs(output, exist_ok=True)
+
+        if options['no_cache']:
+            cache = False
+        else:
+            cache = options['cache_dir'] or True
+        compiled = compile_cruise(options['directory'], workers=options['workers'],
+                                  output_dir=output if options['asc'] else None,
+                                  cache=cache, compact=options['compact'])
+
+        compiled.bottles.to_csv(os.path.join(output, 'bottles.csv'), index=False)
+        compiled.casts.to_csv(os.path.join(output, 'casts.csv'), index=False)
+        compiled.timings.to_csv(os.path.join(output, 'timings.csv'), index=False)
+
+        failed = compiled.timings[compiled.timings['error'].notnull()]
+        for _, row in failed.iterrows():
+            self.stderr.write(f"{row['path']}: {row['error']}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Compiled {len(compiled.casts)} casts and {len(compiled.bottles)} bottles from "
+            f"{len(compiled.timings) - len(failed)} files ({compiled.timings['cached'].sum()} from cache) "
+            f"in {compiled.timings['seconds'].sum():.1f}s of parsing, "
+            f"{compiled.timings['memory_bytes'].sum() / 2**20:.1f} MiB parsed"))
@@ -0,0 +1,41 @@
+# Report on and evict from the parse cache of a CTD directory
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.parsers.ctd.cache import ParseCache
+
+
+class Command(BaseCommand):
+    help = 'Show the size of the CTD parse cache of a directory. --max-bytes evicts least recently used entries, --clear empties it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', type=str, nargs='?', default=None, help='directory containing CTD files')
+        parser.add_argument('--cache-dir', type=str, default=None,
+                            help='directory of the parse cache (default: .ctd_parse_cache in the CTD directory)')
+        parser.add_argument('--max-bytes', type=int, default=None, help='evict entries until the cache is at most this size')
+        parser.add_argument('--clear', action='store_true', default=False, help='delete all entries')
+
+    def handle(self, *args, **options):
+        if options['cache_dir'] is not None:
+            cache = ParseCache(options['cache_dir'])
+        elif options['directory'] is None:
+            raise CommandError('give a CTD directory or --cache-dir')
+        elif not os.path.isdir(options['directory']):
+            raise CommandError(f"cannot find directory {options['directory']}")
+        else:
+            cache = ParseCache.for_directory(options['directory'])
+
+        if options['clear']:
+            evicted = cache.clear()
+        elif options['max_bytes'] is not None:
+            evicted = cache.evict(options['max_bytes'])
+        else:
+            evicted = None
+
+        stats = cache.stats()
+        if evicted is not None:
+            self.stdout.write(f'Evicted {evicted} entries')
+        self.stdout.write(self.style.SUCCESS(
+            f"{cache.cache_dir}: {stats['entries']} entries, {stats['bytes']} bytes"))
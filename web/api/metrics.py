@@ -0,0 +1,100 @@
+# operational metrics, served in the Prometheus text format at /metrics.
+#
+# metrics are collected in-process by prometheus_client. the API runs in more
+# than one process (server workers, plus the spawned job and compile pools), so
+# set PROMETHEUS_MULTIPROC_DIR to a directory shared by all of them, emptied
+# before the server starts. each process then records its samples in files
+# there, and the metrics view adds them up. without it, /metrics only reports
+# the process that serves it.
+#
+# caches report lookups by outcome; their hit ratio is, for example,
+#   rate(neslter_cache_lookups_total{result="hit"}[5m])
+#     / rate(neslter_cache_lookups_total[5m])
+
+import os
+
+from prometheus_client import (CollectorRegistry, Counter, Histogram, REGISTRY,
+                               CONTENT_TYPE_LATEST, generate_latest, multiprocess)
+
+# request latency buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# methods reported as such; anything else is counted as 'other'
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+REQUEST_LATENCY = Histogram('neslter_request_duration_seconds',
+                            'Time to handle a request, including streaming its response',
+                            ['view', 'method'], buckets=LATENCY_BUCKETS)
+REQUESTS = Counter('neslter_requests', 'Requests handled', ['view', 'method', 'status'])
+REQUEST_BYTES = Counter('neslter_request_bytes', 'Request body bytes received', ['view'])
+RESPONSE_BYTES = Counter('neslter_response_bytes', 'Response body bytes sent', ['view'])
+
+ROWS_ENRICHED = Counter('neslter_rows_enriched', 'Rows given a nearest station by add_nearest_station')
+
+FILES_PARSED = Counter('neslter_files_parsed', 'CTD files parsed', ['parser'])
+BYTES_PARSED = Counter('neslter_bytes_parsed', 'Bytes of CTD files parsed', ['parser'])
+
+CACHE_LOOKUPS = Counter('neslter_cache_lookups', 'Cache lookups', ['cache', 'result'])
+
+
+def observe_request(view, method, status, seconds, request_bytes=0, response_bytes=0):
+    view = view or 'unmatched'
+    method = method if method in METHODS else 'other'
+    REQUEST_LATENCY.labels(view, method).observe(seconds)
+    REQUESTS.labels(view, method, str(status)).inc()
+    if request_bytes:
+        REQUEST_BYTES.labels(view).inc(request_bytes)
+    if response_bytes:
+        RESPONSE_BYTES.labels(view).inc(response_bytes)
+
+
+def count_rows_enriched(n):
+    ROWS_ENRICHED.inc(n)
+
+
+def source_size(source):
+    """size in bytes of a file given by path or as a file object (such as an
+    uploaded file), or 0 if it can't be told"""
+    if isinstance(source, (str, os.PathLike)):
+        try:
+            return os.path.getsize(source)
+        except OSError:
+            return 0
+    size = getattr(source, 'size', None) # Django's UploadedFile
+    if size is not None:
+        return size
+    try:
+        position = source.tell()
+        size = source.seek(0, os.SEEK_END)
+        source.seek(position)
+        return size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def count_parsed(parser, source):
+    """count a CTD file (path or file object) parsed by a parser ('hdr', 'btl' or 'asc')"""
+    FILES_PARSED.labels(parser).inc()
+    BYTES_PARSED.labels(parser).inc(source_size(source))
+
+
+def count_cache_lookups(cache, hits=0, misses=0):
+    if hits:
+        CACHE_LOOKUPS.labels(cache, 'hit').inc(hits)
+    if misses:
+        CACHE_LOOKUPS.labels(cache, 'miss').inc(misses)
+
+
+def registry():
+    """the registry to report: all processes' samples in multiprocess mode,
+    otherwise this process's"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def exposition():
+    """(body, content type) of the metrics in the Prometheus text format"""
+    return generate_latest(registry()), CONTENT_TYPE_LATEST
@@ -0,0 +1,190 @@
+# request timing: Server-Timing headers, a JSON log line and request metrics
+# (see api.metrics) per request, and on-demand profiling of a single request
+# for staff users
+
+import cProfile
+import io
+import json
+import logging
+import pstats
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import FileResponse, HttpResponse
+
+from api import metrics
+from api.instrumentation import Timings
+
+logger = logging.getLogger('api.timing')
+
+# functions listed in a cProfile report
+PROFILE_LINES = 60
+
+
+def _query_timer(timings):
+    # a database execute wrapper (see django.db.connection.execute_wrapper)
+    def wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            timings.add_query(time.perf_counter() - start)
+    return wrapper
+
+
+def _is_staff(request):
+    # TimingMiddleware runs before the view has authenticated the request with
+    # its token, so authenticate it here the way the API views will
+    from rest_framework.exceptions import APIException
+    from rest_framework.request import Request
+    from rest_framework.settings import api_settings
+
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    authenticators = [auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES]
+    try:
+        return Request(request, authenticators=authenticators).user.is_staff
+    except APIException:
+        return False
+
+
+class _TimedStream(object):
+    """a streamed body that times producing each chunk, with the request's Timings
+    active so that stages run while streaming (such as reading chunks of an ASC
+    file) are recorded too; their time is also part of render. done is called
+    with the number of bytes sent once the body is finished or closed"""
+
+    def __init__(self, content, timings, done):
+        self.content = iter(content)
+        self.timings = timings
+        self.done = done
+        self.nbytes = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.timings.activated():
+            start = time.perf_counter()
+            try:
+                chunk = next(self.content)
+            except StopIteration:
+                self.close()
+                raise
+            self.timings.add('render', time.perf_counter() - start)
+        self.nbytes += len(chunk)
+        return chunk
+
+    def close(self):
+        # the server closes the response when it is done with it, even if the
+        # client went away before the body was finished
+        if self.done is not None:
+            done, self.done = self.done, None
+            close = getattr(self.content, 'close', None)
+            if close is not None:
+                close()
+            done(self.nbytes)
+
+
+class TimingMiddleware(object):
+    """times each request's stages (see api.instrumentation) and database queries.
+
+    stages that finish before the response is returned are reported in a
+    Server-Timing header (if settings.NESLTER_SERVER_TIMING); all of them,
+    including rendering a streamed body, are logged as one JSON line on the
+    api.timing logger once the response is complete, when the request's latency
+    and byte counts are also added to the metrics. staff users can add
+    ?profile=1 to get a profile of the request instead of its response"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.GET.get('profile', '').lower() in ('1', 'true') and _is_staff(request):
+            return self.profile(request)
+
+        timings = Timings()
+        with timings.activated(), self._timing_queries(timings):
+            response = self.get_response(request)
+        if getattr(settings, 'NESLTER_SERVER_TIMING', True):
+            response['Server-Timing'] = timings.server_timing(total=timings.elapsed())
+
+        # FileResponses aren't wrapped, so the server can still send the file
+        # directly; their size is known up front
+        if isinstance(response, FileResponse):
+            self.finish(request, response, timings, int(response.get('Content-Length', 0)))
+        elif response.streaming:
+            response.streaming_content = _TimedStream(response.streaming_content, timings,
+                lambda nbytes: self.finish(request, response, timings, nbytes))
+        else:
+            self.finish(request, response, timings, len(response.content))
+        return response
+
+    @staticmethod
+    def _timing_queries(timings):
+        # one execute wrapper per connection, combined into one context manager
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(_query_timer(timings)))
+        return stack
+
+    def finish(self, request, response, timings, response_bytes):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match is not None else None
+        try:
+            request_bytes = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            request_bytes = 0
+        metrics.observe_request(view, request.method, response.status_code, timings.elapsed(),
+                                request_bytes, response_bytes)
+        self.log(request, response, view, timings)
+
+    def log(self, request, response, view, timings):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'ms': round(timings.elapsed() * 1000, 3),
+        }
+        record.update(timings.as_dict())
+        logger.info(json.dumps(record))
+
+    def profile(self, request):
+        """run the request under pyinstrument if it is installed, otherwise cProfile,
+        and return the report. a streamed body is rendered (and discarded) too"""
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            Profiler = None
+
+        def run():
+            response = self.get_response(request)
+            if response.streaming:
+                for _ in response.streaming_content:
+                    pass
+            response.close()
+
+        if Profiler is not None:
+            profiler = Profiler()
+            profiler.start()
+            try:
+                run()
+            finally:
+                profiler.stop()
+            return HttpResponse(profiler.output_html(), content_type='text/html')
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            run()
+        finally:
+            profiler.disable()
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return HttpResponse(report.getvalue(), content_type='text/plain')
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_station_full_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stationlocation',
+            index=models.Index(fields=['start_time', 'end_time'], name='api_stationloc_validity_idx'),
+        ),
+    ]
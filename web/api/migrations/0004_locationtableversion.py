@@ -0,0 +1,24 @@
+from django.db import migrations, models
+
+
+def create_version_row(apps, schema_editor):
+    LocationTableVersion = apps.get_model('api', 'LocationTableVersion')
+    LocationTableVersion.objects.get_or_create(pk=1, defaults={'version': 0})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_stationlocation_knn_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocationTableVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version_row, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,36 @@
 from django.db import models as models
+from django.db import transaction
 from django.contrib.gis.db import models as gis_models
 from django.contrib.gis.geos import Point
+from django.contrib.gis.measure import D
 from django.contrib.contenttypes.fields import GenericForeignKey, GenericRelation
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Q
+from django.db.models import Q, Func, FloatField
 from django.utils import timezone
 
+import numpy as np
+import pandas as pd
+
+from api.geo import to_utc_nanoseconds
+from api.index import invalidate_location_index, location_index
+
+
+# coordinate accessors for point geolocations, so that they can be
+# fetched with values_list instead of instantiating GEOS geometries
+class Latitude(Func):
+    function = 'ST_Y'
+    output_field = FloatField()
+
+class Longitude(Func):
+    function = 'ST_X'
+    output_field = FloatField()
+
+# a single row whose version is bumped by api.index.invalidate_location_index
+# in the same transaction as each write to the location table, so that every
+# process can tell when its in-memory location index is out of date
+class LocationTableVersion(models.Model):
+    version = models.BigIntegerField(default=0)
+
 # TimeStampedModelInstance class
 class TimeStampedModelInstance(models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
@@ -23,6 +48,12 @@ class StationLocation(TimeStampedModelInstance):
     depth = models.FloatField(null=True, blank=True)
     comment = models.TextField(null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # time validity filter of get_location and station-list queries
+            models.Index(fields=['start_time', 'end_time'], name='api_stationloc_validity_idx'),
+        ]
+
     def get_station(self):
         return self.content_object
     
@@ -35,6 +66,13 @@ class Station(models.Model):
     full_name = models.CharField(max_length=200, null=True, blank=True)
     locations = GenericRelation(StationLocation, related_query_name='station')
 
+    def delete(self, *args, **kwargs):
+        # the station's locations are deleted along with it
+        with transaction.atomic():
+            result = super(Station, self).delete(*args, **kwargs)
+            invalidate_location_index()
+        return result
+
     def set_location(self, latitude, longitude, start_time, end_time=None, depth=None, comment=None):
         if end_time is not None:
             if end_time == start_time:
@@ -70,44 +108,67 @@ class Station(models.Model):
             comment=comment
         )
 
+        invalidate_location_index()
+
     def get_location(self, timestamp=None):
         if timestamp is None:
             timestamp = timezone.now()
 
-        locations = self.locations.filter(
+        return self.locations.filter(
             Q(end_time__gte=timestamp) | Q(end_time__isnull=True),
             start_time__lte=timestamp
-        ).order_by('-start_time')
-
-        if locations.exists():
-            return locations.first()
-        else:
-            return None
+        ).order_by('-start_time').first()
 
     @classmethod
-    def distances(cls, latitude, longitude, timestamp):
-        from django.contrib.gis.db.models.functions import Distance
-
-        # Create a Point object from the latitude and longitude
-        geolocation = Point(longitude, latitude, srid=4326)
+    def locations_at(cls, timestamp=None):
+        # the location of every station at the given time (the most recently
+        # started one, as in get_location), in a single DISTINCT ON query
+        if timestamp is None:
+            timestamp = timezone.now()
 
         return StationLocation.objects.filter(
             Q(end_time__gte=timestamp) | Q(end_time__isnull=True),
             start_time__lte=timestamp
-        ).annotate(distance=Distance('geolocation', geolocation)).order_by('distance')
-
+        ).order_by('object_id', '-start_time').distinct('object_id')
 
     @classmethod
     def nearest_location(cls, latitude, longitude, timestamp=None):
         if timestamp is None:
             timestamp = timezone.now()
 
-        distances = cls.distances(latitude, longitude, timestamp)
+        # answered from the in-memory location index, as add_nearest_station is,
+        # then the matching location is fetched by primary key
+        index = location_index()
+        ix, distance_m = index.nearest(np.array([float(latitude)]), np.array([float(longitude)]),
+                                       to_utc_nanoseconds([timestamp]))
+        if ix[0] < 0:
+            return None
 
-        if distances.exists():
-            return distances.first()
-        else:
+        location = StationLocation.objects.filter(pk=int(index.locations['id'].iloc[ix[0]])).first()
+        if location is None: # deleted since the index was built
             return None
+        location.distance_m = float(distance_m[0])
+        location.distance = D(m=location.distance_m)
+        return location
+
+    @classmethod
+    def location_frame(cls, start_time=None, end_time=None):
+        # all station locations valid at any time between start_time and end_time,
+        # as a DataFrame, in a single query
+        locations = StationLocation.objects.all()
+        if end_time is not None:
+            locations = locations.filter(start_time__lte=end_time)
+        if start_time is not None:
+            locations = locations.filter(Q(end_time__gte=start_time) | Q(end_time__isnull=True))
+
+        columns = ['id', 'station_id', 'station', 'latitude', 'longitude', 'depth', 'start_time', 'end_time', 'comment']
+        rows = locations.order_by('id').values_list('id', 'object_id', 'station__name',
+            Latitude('geolocation'), Longitude('geolocation'), 'depth', 'start_time', 'end_time', 'comment')
+
+        df = pd.DataFrame.from_records(list(rows), columns=columns)
+        df['start_time'] = pd.to_datetime(df['start_time'], utc=True)
+        df['end_time'] = pd.to_datetime(df['end_time'], utc=True)
+        return df
         
 
     def __str__(self):
@@ -1,14 +1,39 @@
-
 import os
 
-from .asc import parse_cast
+from .asc import cast_index, read_cast, parse_cast_number
+from .cache import ParseCache
 
 class Ctd(object):
-    def __init__(self, cruise, raw_dir, check_exists=True):
+    def __init__(self, cruise, raw_dir, check_exists=True, cache=False, compact=False):
         self.cruise = cruise
         if check_exists:
             if not os.path.exists(raw_dir):
                 raise IOError(f'cannot find directory {raw_dir}')
         self.raw_dir = raw_dir
+        # parsed casts can be kept in a ParseCache in the raw directory
+        if cache is True:
+            cache = ParseCache.for_directory(raw_dir)
+        self.cache = cache or None
+        # whether parsed casts are downcast by compact_dtypes
+        self.compact = compact
+        self._index = None
+        self._index_mtime = None
+    def cast_index(self):
+        """cast number -> ASC file path. built once, and rebuilt only when
+        the directory's mtime changes (i.e., files are added or removed)"""
+        mtime = os.stat(self.raw_dir).st_mtime_ns
+        if self._index is None or mtime != self._index_mtime:
+            self._index = cast_index(self.raw_dir, self.cruise)
+            self._index_mtime = mtime
+        return self._index
+    def cast_numbers(self):
+        return sorted(self.cast_index())
     def cast(self, cast_number):
-        return parse_cast(self.raw_dir, cast_number)
+        path = self.cast_index().get(parse_cast_number(cast_number))
+        if path is None:
+            raise ValueError('cast not found: {}'.format(cast_number))
+        return read_cast(path, self.cruise, cast_number, cache=self.cache, compact=self.compact)
+    def casts(self):
+        """iterate over (cast number, parsed cast), parsing each cast as it is reached"""
+        for cast_number in self.cast_numbers():
+            yield cast_number, self.cast(cast_number)
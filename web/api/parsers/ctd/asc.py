@@ -1,68 +1,156 @@
 import os
 from glob import glob
+from io import StringIO
 
 import pandas as pd
 
+from api.instrumentation import stage, timed_chunks
+from api.metrics import count_parsed
 from api.parsers.utils import clean_column_names
+from .common import compact_dtypes, p_to_z, parse_cast_filename
 
-def parse_asc_csv(asc_path, delimiter=';'):
-    df = pd.read_csv(asc_path, encoding='latin-1', delimiter=delimiter)
+# cleaned column names of the pressure, depth and latitude columns
+PRESSURE_COL = 'prdm'
+DEPTH_COL = 'depsm'
+LAT_COL = 'latitude'
+
+def add_depth(df, latitude=None):
+    """add a depth column computed from pressure, if the cast has pressure but no depth.
+    latitude is a scalar; if it is None, the cast's own latitude column is used if present"""
+    if DEPTH_COL in df.columns or PRESSURE_COL not in df.columns:
+        return df
+    if latitude is None:
+        if LAT_COL not in df.columns:
+            return df
+        latitude = df[LAT_COL].to_numpy(dtype=float)
+    df[DEPTH_COL] = p_to_z(df[PRESSURE_COL].to_numpy(dtype=float), latitude)
     return df
 
-def parse_asc_fwf(asc_path):
+# how much of the start of a file to read when sniffing its format
+SNIFF_BYTES = 8192
+
+def _head_lines(fin, nbytes=SNIFF_BYTES, n_lines=3):
+    """read whole lines from the start of a binary file, at least n_lines
+    if the file has that many, reading nbytes at a time"""
+    head = b''
+    while head.count(b'\n') < n_lines:
+        block = fin.read(nbytes)
+        if not block:
+            return head.decode('latin-1').splitlines()
+        head += block
+    # drop the (possibly partial) last line
+    return head.decode('latin-1').splitlines()[:head.count(b'\n')]
+
+def _n_columns(text, **kw):
+    return len(pd.read_csv(StringIO(text), nrows=1, **kw).columns)
+
+def sniff_asc(asc_path, delimiter=',', infer_delimiter=True):
+    """determine the format of an ASC file from the first few KB only.
+    returns keyword arguments for read_asc: a delimiter for CSV, or column
+    widths for fixed-width files"""
+    if isinstance(asc_path, str):
+        with open(asc_path, 'rb') as fin:
+            lines = _head_lines(fin)
+    else:
+        lines = _head_lines(asc_path)
+        asc_path.seek(0)
+
+    if not lines:
+        raise ValueError('ASC file is empty')
+    head = '\n'.join(lines) + '\n'
+
+    # duck type to see if this is CSV or fixed-width
+    delimiters = [delimiter]
+    if infer_delimiter: # whoops, try a different delimiter
+        delimiters += [d for d in [',', ';'] if d != delimiter]
+    for d in delimiters:
+        if _n_columns(head, delimiter=d) > 1:
+            return { 'delimiter': d }
+
     # do some hacking to determine width of columns
-    # first, read the file without the header to determine how many columns.
+    # first, read the first data line to determine how many columns.
     # we can't do this from the header because in fixed-width files the
     # column names might not have any whitespace between them.
     # if this is the case for data values, this whole approach will fail
-    df = pd.read_fwf(asc_path, skiprows=1, nrows=1, header=None, encoding='latin-1')
-    n_cols = len(df.columns)  
-    # now get the length of the first line which contains headers
-    with open(asc_path, encoding='latin-1') as fin:
-        for line in fin.readlines():
-            break
+    if len(lines) < 2:
+        raise ValueError('cannot determine columns of fixed-width ASC file')
+    n_cols = len(pd.read_fwf(StringIO(head), skiprows=1, nrows=1, header=None).columns)
     # assume all columns are the same width. determine that width
-    line = line.rstrip()
-    col_width = int(len(line) / n_cols)
-    col_widths = [col_width for _ in range(n_cols)]
-    # now parse the fixed-width format
-    df = pd.read_fwf(asc_path, widths=col_widths, encoding='latin-1')
-    return df
+    # from the length of the first line which contains headers
+    col_width = int(len(lines[0].rstrip()) / n_cols)
+    return { 'widths': [col_width for _ in range(n_cols)] }
 
-def parse_asc(asc_path, delimiter=',', infer_delimiter=True):
-    # duck type to see if this is CSV or fixed-width
-    df = parse_asc_csv(asc_path, delimiter)
-    if infer_delimiter and len(df.columns) == 1: # whoops, try a different delimiter
-        if delimiter == ',':
-            delimiter = ';'
-        elif delimiter == ';':
-            delimiter = ','
-        asc_path.seek(0)
-        df = parse_asc_csv(asc_path, delimiter)
-    if len(df.columns) == 1: # try fixed-width
-        asc_path.seek(0)
-        df = parse_asc_fwf(asc_path)
-    df = clean_column_names(df)
-    return df
+def read_asc(asc_path, delimiter=None, widths=None, chunksize=None, latitude=None, depth=False, compact=False):
+    """read an ASC file in the format given by sniff_asc, cleaning column names.
+    with depth, a depth column is derived from pressure (see add_depth). with a chunksize, returns an iterator of DataFrames of at most
+    that many rows, so the file is read once in bounded memory. with compact,
+    columns are downcast by compact_dtypes"""
+    if widths is not None:
+        reader = pd.read_fwf(asc_path, widths=widths, encoding='latin-1', chunksize=chunksize)
+    else:
+        reader = pd.read_csv(asc_path, encoding='latin-1', delimiter=delimiter, chunksize=chunksize)
+
+    def clean(df):
+        df = clean_column_names(df, inplace=True)
+        if depth:
+            df = add_depth(df, latitude)
+        if compact:
+            df = compact_dtypes(df)
+        return df
+
+    if chunksize is None:
+        return clean(reader)
+    return (clean(df) for df in reader)
 
+def parse_asc(asc_path, delimiter=',', infer_delimiter=True, latitude=None, depth=False, chunksize=None, compact=False):
+    count_parsed('asc', asc_path)
+    with stage('parse_asc') as s:
+        asc_format = sniff_asc(asc_path, delimiter, infer_delimiter)
+        result = read_asc(asc_path, chunksize=chunksize, latitude=latitude, depth=depth, compact=compact, **asc_format)
+        if chunksize is None:
+            s.rows = len(result)
+    if chunksize is not None: # chunks are timed as they are read
+        result = timed_chunks('parse_asc', result)
+    return result
 
-def parse_cast(asc_dir, cruise, cast=1, delimiter=';'):
+
+def cast_index(asc_dir, cruise=None):
+    """map cast number to the path of its ASC file, from file names like
+    EN627_026_u.asc. if cruise is given, files of other cruises are ignored"""
+    index = {}
     for p in sorted(glob(os.path.join(asc_dir, '*.asc'))):
-        b = os.path.basename(p)
-        fcast = cast # internal name
-        if cruise is None or fcast is None: # bad filename, skip
+        fcruise, fcast = parse_cast_filename(p)
+        if fcast is None: # bad filename, skip
+            continue
+        if cruise is not None and fcruise != cruise.upper():
             continue
-        try:
-            if int(cast) == int(fcast):
-                df = parse_asc(p, delimiter)
-                df.insert(0, 'cast', cast)
-                df.insert(0, 'cruise', cruise)
-                return df
-        except ValueError:
-            if (cast.lstrip("0") == fcast.lstrip("0")):
-                df = parse_asc(p, delimiter)
-                df.insert(0, 'cast', cast)
-                df.insert(0, 'cruise', cruise)
-                return df
-
-    raise ValueError('cast not found: {}'.format(cast))
+        index.setdefault(fcast, p)
+    return index
+
+
+def parse_cast_number(cast):
+    try:
+        return int(cast)
+    except (TypeError, ValueError):
+        raise ValueError('cast not found: {}'.format(cast))
+
+
+def read_cast(path, cruise, cast, delimiter=';', cache=None, compact=False):
+    """parse the ASC file of a cast, adding cruise and cast columns"""
+    df = cache.frame(path) if cache is not None else parse_asc(path, delimiter)
+    df.insert(0, 'cast', cast)
+    df.insert(0, 'cruise', cruise)
+    if compact:
+        df = compact_dtypes(df)
+    return df
+
+
+def parse_cast(asc_dir, cruise, cast=1, delimiter=';', cache=None, index=None, compact=False):
+    """parse the ASC file of one cast. pass the cast_index of asc_dir
+    to avoid listing the directory"""
+    if index is None:
+        index = cast_index(asc_dir, cruise)
+    path = index.get(parse_cast_number(cast))
+    if path is None:
+        raise ValueError('cast not found: {}'.format(cast))
+    return read_cast(path, cruise, cast, delimiter, cache, compact)
@@ -1,12 +1,14 @@
-import math
 from glob import glob
 import os
 import warnings
 
+import numpy as np
 import pandas as pd 
 
-from .common import CtdTextParser
+from .common import CtdTextParser, compact_dtypes, memory_report, p_to_z
 from api.parsers.utils import clean_column_names
+from api.instrumentation import timed
+from api.metrics import count_parsed
 
 # column names
 
@@ -24,6 +26,9 @@ LON_COL = 'Longitude'
 CRUISE_COL = 'Cruise'
 CAST_COL = 'Cast'
 
+# format of the date and time columns once joined, e.g., Oct 21 2019 00:19:11
+DATE_FORMAT = '%b %d %Y %H:%M:%S'
+
 def _col_values(line, col_widths, justification='right'):
     """read fixed-width column values"""
     if justification not in ['left', 'right', 'center']:
@@ -47,36 +52,47 @@ def _col_values(line, col_widths, justification='right'):
 
     return vals
 
-def p_to_z(p, latitude):
-    """convert pressure to depth in seawater.
-    p = pressure in dbars
-    latitude"""
+def _col_arrays(lines, col_widths):
+    """read fixed-width column values from many lines at once. returns one
+    numpy string array per column. values are not stripped of whitespace"""
+    width = sum(col_widths)
+    # one row of characters per line, truncated or padded to the total width
+    chars = np.array(lines, dtype=f'U{width}').view('U1').reshape(len(lines), width)
+    cols = []
+    i = 0
 
-    # use the Seabird calculation
-    # from http://www.seabird.com/document/an69-conversion-pressure-depth
+    for w in col_widths:
+        cols.append(np.ascontiguousarray(chars[:, i:i+w]).view(f'U{w}').ravel())
+        i += w
 
-    x = math.pow(math.sin(latitude / 57.29578),2)
-    g = 9.780318 * ( 1.0  + (5.2788e-3 + 2.36e-5 * x) * x ) + 1.092e-6 * p
-    
-    depth_m_sw = ((((-1.82e-15 * p + 2.279e-10) * p - 2.2512e-5) * p + 9.72659) * p) / g
-    
-    return depth_m_sw
+    return cols
 
 class BtlFile(CtdTextParser):
     def __init__(self, **kw):
         self._df = None
+        self._compact = False
         super(BtlFile, self).__init__(**kw)
-    def to_dataframe(self):
-        if self._df is not None:
-            return self._df
-
-        # read lines of file, skipping headers
-        lines = []
-
-        for l in self._lines:
-            if l.startswith('#') or l.startswith('*'):
-                continue
-            lines.append(l)
+    def to_dataframe(self, compact=False):
+        """the bottle data. with compact, a copy with columns downcast by compact_dtypes
+        is returned and kept in place of the full size frame, so frames returned
+        earlier don't change. once compacted, the stored frame stays compact"""
+        if self._df is None:
+            self._df = self._read_dataframe()
+        if compact and not self._compact:
+            self._df = compact_dtypes(self._df.copy())
+            self._compact = True
+        return self._df
+
+    def memory_report(self):
+        """bytes used by each column of the bottle data and the total (see memory_report)"""
+        return memory_report(self.to_dataframe())
+
+    @timed('parse_btl', rows=len)
+    def _read_dataframe(self):
+        count_parsed('btl', self.path if self.data is None else self.data)
+
+        # read lines of file following the header
+        lines = [l for l in self._data_lines() if not (l.startswith('#') or l.startswith('*'))]
 
         # column headers are fixed width at 11 characters per column,
         # except the first two
@@ -116,24 +132,25 @@ class BtlFile(CtdTextParser):
         value_col_widths = [11] * (n_cols - 2)
         col_widths = [bottle_column_width, datetime_column_width] + value_col_widths
 
-        # now assemble the rows of the dataframe
-        rows = []
+        # slice all the lines into columns at once
+        cols = _col_arrays(avg_lines, col_widths)
+        # date/time is split across two rows
+        times = _col_arrays(time_lines, col_widths[:DATE_COL_IX+1])[DATE_COL_IX]
+        dates = np.char.add(np.char.add(np.char.strip(cols[DATE_COL_IX]), ' '), np.char.strip(times))
+        try:
+            dates = pd.to_datetime(dates, format=DATE_FORMAT, utc=True)
+        except ValueError:
+            dates = pd.to_datetime(dates, utc=True)
 
-        for al, tl in zip(avg_lines, time_lines):
-            cvs = _col_values(al, col_widths)
-            # date/time is split across two rows
-            time = _col_values(tl, col_widths)[DATE_COL_IX]
-            cvs[DATE_COL_IX] = '{} {}'.format(cvs[DATE_COL_IX], time)
-            rows.append(cvs)
+        # convert columns to reasonable types
+        data = {}
+        data[col_headers[0]] = cols[0].astype(int)
+        data[col_headers[DATE_COL_IX]] = dates
 
-        df = pd.DataFrame(rows, columns=col_headers)
+        for c, values in zip(col_headers[2:], cols[2:]):
+            data[c] = values.astype(float)
 
-        # convert df columns to reasonable types
-        df[BOTTLE_COL] = df[BOTTLE_COL].astype(int)
-        df[DATE_COL] = pd.to_datetime(df[DATE_COL], utc=True)
-
-        for c in df.columns[2:]:
-            df[c] = df[c].astype(float)
+        df = pd.DataFrame(data)
 
         # add cruise / cast
         # df[CRUISE_COL] = self.cruise
@@ -146,18 +163,16 @@ class BtlFile(CtdTextParser):
 
         # add depth column if necessary
         if DEPTH_COL not in df.columns and PRESSURE_COL in df.columns:
-            df[DEPTH_COL] = self.depths().values
+            df[DEPTH_COL] = p_to_z(df[PRESSURE_COL].to_numpy(), self.lat)
         # add lat/lon if necessary
         if LAT_COL not in df.columns and LON_COL not in df.columns:
-            df[LAT_COL] = self.lats().values
-            df[LON_COL] = self.lons().values
+            df[LAT_COL] = self.lat
+            df[LON_COL] = self.lon
         df = clean_column_names(df, {
             'Bottle': 'niskin'
             })
         df = df.astype({ 'niskin': int })
 
-        self._df = df
-
         return df
 
 
@@ -188,8 +203,7 @@ class BtlFile(CtdTextParser):
         if DEPTH_COL in df.columns:
             return self._col(DEPTH_COL)
         elif PRESSURE_COL in df.columns:
-            ps = [p_to_z(p, self.lat) for p in df[PRESSURE_COL]]
-            s = pd.Series(ps, index=df[BOTTLE_COL])
+            s = pd.Series(p_to_z(df[PRESSURE_COL].to_numpy(), self.lat), index=df[BOTTLE_COL])
             return s
         else:
             raise KeyError('no source of depth information found')
@@ -0,0 +1,166 @@
+# on-disk cache of parsed CTD files, so a directory can be recompiled
+# without reparsing the files that haven't changed. the cache is only an
+# optimization: entries that can't be read or written are parsed instead
+
+import hashlib
+import logging
+import os
+import uuid
+
+import pandas as pd
+
+from api.metrics import count_cache_lookups
+
+logger = logging.getLogger(__name__)
+
+# name of the cache directory kept next to the data
+CACHE_DIRNAME = '.ctd_parse_cache'
+
+# part of every key. change it when parser output changes, to invalidate old entries
+PARSER_VERSION = 1
+
+
+def hdr_frame(path):
+    """the time and position from a .hdr file as a one-row DataFrame"""
+    from .hdr import HdrFile
+    hf = HdrFile(path=path)
+    return pd.DataFrame({
+        'date': pd.to_datetime([hf.time], utc=True),
+        'latitude': [hf.lat],
+        'longitude': [hf.lon],
+    })
+
+
+def btl_frame(path):
+    from .btl import BtlFile
+    return BtlFile(path=path).to_dataframe()
+
+
+def asc_frame(path):
+    from .asc import parse_asc
+    # with depth, so compiled casts can report their maximum depth
+    return parse_asc(path, depth=True)
+
+
+PARSERS = {
+    'hdr': hdr_frame,
+    'btl': btl_frame,
+    'asc': asc_frame,
+}
+
+
+def file_kind(path):
+    return os.path.splitext(path)[1].lower().lstrip('.')
+
+
+class ParseCache(object):
+    """parsed HdrFile, BtlFile and ASC results stored as parquet files named by
+    a hash of the source file's path, size and modification time, so a changed
+    file gets a new entry. entries are evicted least recently used first"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def for_directory(cls, data_dir):
+        """the cache kept in a data directory"""
+        return cls(os.path.join(data_dir, CACHE_DIRNAME))
+
+    def key(self, path):
+        st = os.stat(path)
+        source = f'{PARSER_VERSION}:{os.path.realpath(path)}:{st.st_size}:{st.st_mtime_ns}'
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    def entry_path(self, path):
+        return os.path.join(self.cache_dir, self.key(path) + '.parquet')
+
+    def __contains__(self, path):
+        return os.path.exists(self.entry_path(path))
+
+    def get(self, path):
+        """the cached DataFrame for a file, or None if it has none (or its
+        entry can't be read)"""
+        entry = self.entry_path(path)
+        try:
+            df = pd.read_parquet(entry)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f'cannot read parse cache entry {entry}: {e}')
+            self.misses += 1
+            count_cache_lookups('parse_cache', misses=1)
+            return None
+        try:
+            os.utime(entry) # mark as recently used
+        except OSError: # e.g., a read-only cache
+            pass
+        self.hits += 1
+        count_cache_lookups('parse_cache', hits=1)
+        return df
+
+    def put(self, path, df):
+        """store the DataFrame for a file. returns False if it couldn't be
+        stored, e.g., because the cache directory isn't writable"""
+        entry = self.entry_path(path)
+        # write then rename, so concurrent readers never see a partial entry
+        tmp_path = f'{entry}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            df.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, entry)
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f'cannot write parse cache entry {entry}: {e}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def frame(self, path):
+        """the parsed DataFrame for a CTD file, parsing it only if it isn't cached"""
+        df = self.get(path)
+        if df is None:
+            df = PARSERS[file_kind(path)](path)
+            self.put(path, df)
+        return df
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.parquet'):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def evict(self, max_bytes):
+        """delete least recently used entries until the cache is at most max_bytes.
+        returns the number of entries deleted"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        n = 0
+        for _, size, name in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            n += 1
+        return n
+
+    def clear(self):
+        return self.evict(0)
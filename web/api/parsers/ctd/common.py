@@ -1,12 +1,17 @@
 import re
 import os
+import mmap
+import itertools
 import glob as glob
 
+from contextlib import closing
 from io import BytesIO
 
 import pandas as pd
 import numpy as np
 
+from api.instrumentation import stage
+
 CRUISE_IDX = 1
 CAST_IDX = 2
 
@@ -20,63 +25,238 @@ def parse_lat_lon(ll):
     return deg
 
 
-import io
+# cruise and cast from file names like EN627_026_u.hdr or AR22-03.btl,
+# or without a separator, en608001.asc (the cast is the last three digits)
+SEPARATED_CAST_REGEX = re.compile(r'^(?P<cruise>[A-Za-z]+\d+)[_-](?P<cast>\d+)')
+JOINED_CAST_REGEX = re.compile(r'^(?P<cruise>[A-Za-z]+\d+?)(?P<cast>\d{3})(?!\d)')
+
+
+def parse_cast_filename(path):
+    """(cruise, cast) from the name of a CTD file, or (None, None) if the
+    name doesn't follow a known pattern. cruise is uppercased and cast is
+    an int"""
+    name = os.path.basename(path)
+    match = SEPARATED_CAST_REGEX.match(name) or JOINED_CAST_REGEX.match(name)
+    if match is None:
+        return None, None
+    return match.group('cruise').upper(), int(match.group('cast'))
+
+
+def p_to_z(p, latitude):
+    """convert pressure to depth in seawater.
+    p = pressure in dbars
+    latitude
+    either may be a scalar or an array; arrays are broadcast
+    against each other"""
+
+    # use the Seabird calculation
+    # from http://www.seabird.com/document/an69-conversion-pressure-depth
+
+    p = np.asarray(p, dtype=float)
+    latitude = np.asarray(latitude, dtype=float)
+
+    x = np.sin(latitude / 57.29578) ** 2
+    g = 9.780318 * ( 1.0  + (5.2788e-3 + 2.36e-5 * x) * x ) + 1.092e-6 * p
+    
+    depth_m_sw = ((((-1.82e-15 * p + 2.279e-10) * p - 2.2512e-5) * p + 9.72659) * p) / g
+    
+    if depth_m_sw.ndim == 0:
+        return float(depth_m_sw)
+    return depth_m_sw
+
+
+# most decimal places a value can have and still be considered for float32
+MAX_DECIMALS = 7
+
+def _decimals(values):
+    """the fewest decimal places that represent every value exactly, or None"""
+    for d in range(MAX_DECIMALS + 1):
+        if np.array_equal(np.round(values, d), values):
+            return d
+    return None
+
+def float32_is_lossless(values):
+    """whether a float64 array of values read from text (so with a fixed number of
+    decimal places) can be stored as float32 and rounded back to the same values"""
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    d = _decimals(values)
+    if d is None:
+        return False
+    return np.array_equal(np.round(values.astype(np.float32).astype(np.float64), d), values)
+
+def compact_dtypes(df, categories=('cruise', 'cast')):
+    """downcast the columns of a parsed DataFrame, in place: floats to float32 where
+    that loses no precision, integers to the smallest integer type that holds them,
+    and the columns named in categories to categoricals"""
+    for c in df.columns:
+        col = df[c]
+        if c in categories:
+            df[c] = col.astype('category')
+        elif pd.api.types.is_float_dtype(col) and float32_is_lossless(col.to_numpy()):
+            df[c] = col.astype(np.float32)
+        elif pd.api.types.is_integer_dtype(col):
+            df[c] = pd.to_numeric(col, downcast='integer')
+    return df
+
+def memory_report(df):
+    """bytes used by each column of a DataFrame (including the index) and the total"""
+    usage = df.memory_usage(deep=True)
+    report = { 'columns': { str(k): int(v) for k, v in usage.items() } }
+    report['total'] = int(usage.sum())
+    return report
+
+
+class Header(object):
+    """the header block at the top of a text file: the lines starting with
+    one of the header prefixes, up to and including the end marker if any.
+    subclasses extract fields from header lines in scan_line"""
+    prefixes = ('*', '#')
+    end_marker = '*END*'
+
+    def __init__(self):
+        self.lines = []
+
+    @classmethod
+    def scan(cls, lines):
+        """read the header from the start of a sequence of lines in a single pass.
+        returns the header and the number of lines it occupies"""
+        header = cls()
+        n = 0
+        for line in lines:
+            if not line.startswith(header.prefixes):
+                break
+            n += 1
+            if line.startswith(header.end_marker):
+                break
+            header.lines.append(line)
+            header.scan_line(line)
+        return header, n
+
+    def scan_line(self, line):
+        pass
+
+
+# Sea-Bird header lines
+NMEA_TIME_PREFIX = '* NMEA UTC (Time)'
+SYSTEM_TIME_PREFIX = '* System UTC'
+NMEA_LAT_PREFIX = '* NMEA Latitude'
+NMEA_LON_PREFIX = '* NMEA Longitude'
+NAME_PREFIX = '# name '
+
+VALUE_REGEX = re.compile(r'.*= (.*)')
+LAT_LON_VALUE_REGEX = re.compile(r'.*itude = (.*)')
+NAME_REGEX = re.compile(r'# name \d+ = ([^:]+): ([^\[]+)(?:\[(.*)\](, .*)?)?')
+
+class CtdHeader(Header):
+    """header of a Sea-Bird CTD text file (.hdr, .btl, .cnv):
+    cast time and position, and the names, definitions and units of
+    the recorded variables"""
+
+    def __init__(self):
+        super(CtdHeader, self).__init__()
+        self._nmea_time = None
+        self._system_time = None
+        self._lat = None
+        self._lon = None
+        self.names = []
+        self.definitions = {}
+        self.units = {}
+        self.params = {}
+
+    def scan_line(self, line):
+        # the first matching line of each kind wins
+        if line.startswith(NAME_PREFIX):
+            match = NAME_REGEX.match(line)
+            if match is None:
+                return
+            name, defn, unit, param = match.groups()
+            defn = defn.rstrip() # FIXME do in regex?
+            if param is not None:
+                param = param.lstrip(', ') # FIXME do in regex?
+            self.names.append(name)
+            self.definitions[name] = defn
+            self.units[name] = unit
+            self.params[name] = param
+        elif line.startswith(NMEA_TIME_PREFIX):
+            if self._nmea_time is None:
+                self._nmea_time = VALUE_REGEX.match(line).group(1)
+        elif line.startswith(SYSTEM_TIME_PREFIX):
+            if self._system_time is None:
+                self._system_time = VALUE_REGEX.match(line).group(1)
+        elif line.startswith(NMEA_LAT_PREFIX):
+            if self._lat is None:
+                self._lat = LAT_LON_VALUE_REGEX.match(line).group(1)
+        elif line.startswith(NMEA_LON_PREFIX):
+            if self._lon is None:
+                self._lon = LAT_LON_VALUE_REGEX.match(line).group(1)
+
+    @property
+    def time(self):
+        time = self._nmea_time if self._nmea_time is not None else self._system_time
+        if time is None:
+            return pd.NaT
+        return pd.to_datetime(time, utc=True)
+
+    @property
+    def lat(self):
+        return parse_lat_lon(self._lat) if self._lat is not None else np.nan
+
+    @property
+    def lon(self):
+        return parse_lat_lon(self._lon) if self._lon is not None else np.nan
+
 
 class TextParser(object):
+    """a text file made of a header followed by data lines.
+
+    given a path, the file is memory-mapped and decoded a line at a time as it
+    is iterated, so neither the file nor a list of its lines is held in memory;
+    only the header lines are kept. given a buffer (any binary file object),
+    lines are read from it the same way"""
+    header_class = Header
+
     def __init__(self, path=None, buffer=None, parse=True, encoding='latin-1'):
         if buffer is None:
             if not os.path.exists(path):
                 raise IOError(f'cannot find file {path}')
-            with open(path, 'rb') as fin:
-                buffer = io.BytesIO(fin.read())
+        self.path = path
         self.data = buffer
         self.encoding = encoding
         if parse:
             self.parse()
 
-    def parse(self):
-        lines = []
-        with io.TextIOWrapper(self.data, encoding=self.encoding) as fin:
-            for line in fin.readlines():
-                lines.append(line.rstrip())
-        self._lines = lines
+    def _iter_lines(self):
+        """decoded, right-stripped lines of the file, one at a time"""
+        if self.data is not None:
+            self.data.seek(0)
+            for raw in self.data:
+                yield raw.decode(self.encoding).rstrip()
+            return
+        with open(self.path, 'rb') as fin:
+            if os.fstat(fin.fileno()).st_size == 0: # empty files can't be mapped
+                return
+            with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for raw in iter(mm.readline, b''):
+                    yield raw.decode(self.encoding).rstrip()
 
-    def _lines_that_match(self, regex):
-        for line in self._lines:
-            if re.match(regex, line):
-                yield line
+    def parse(self):
+        # the header is read up to its end, the rest of the file isn't touched
+        with stage('parse_header'), closing(self._iter_lines()) as lines:
+            self.header, self._header_length = self.header_class.scan(lines)
 
-    def _line_that_matches(self, regex):
-        for line in self._lines_that_match(regex):
-            return line
+    def _data_lines(self):
+        """iterator over the lines following the header"""
+        return itertools.islice(self._iter_lines(), self._header_length, None)
 
 class CtdTextParser(TextParser):
     """parent class of BtlFile and HdrFile"""
+    header_class = CtdHeader
+
     def __init__(self, **kw):
         super(CtdTextParser, self).__init__(**kw)
     def parse(self):
         super(CtdTextParser, self).parse()
-        self._parse_time()
-        self._parse_lat_lon()
-    def _parse_time(self):
-        line = self._line_that_matches(r'\* NMEA UTC \(Time\)')
-        line2 = self._line_that_matches(r'\* System UTC')
-        if line is None:
-            line = line2
-        if line is None:
-            self.time = pd.NaT
-            return
-        time = re.match(r'.*= (.*)', line).group(1)
-        self.time = pd.to_datetime(time, utc=True)
-    def _parse_lat_lon(self):
-        lat_line = self._line_that_matches(r'\* NMEA Latitude')
-        lon_line = self._line_that_matches(r'\* NMEA Longitude')
-        split_regex = r'.*itude = (.*)'
-        if lat_line is not None:
-            self.lat = parse_lat_lon(re.match(split_regex, lat_line).group(1))
-        else:
-            self.lat = np.nan
-        if lon_line is not None:
-            self.lon = parse_lat_lon(re.match(split_regex, lon_line).group(1))
-        else:
-            self.lon = np.nan
+        self.time = self.header.time
+        self.lat = self.header.lat
+        self.lon = self.header.lon
@@ -0,0 +1,177 @@
+# compile all the CTD files of a cruise, parsing them in parallel
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+from multiprocessing import get_context
+
+import pandas as pd
+
+from .cache import ParseCache, PARSERS, file_kind
+from .common import compact_dtypes, memory_report, parse_cast_filename
+
+CTD_EXTENSIONS = ('.hdr', '.btl', '.asc')
+
+def find_ctd_files(cruise_dir):
+    """paths of all the .hdr, .btl and .asc files in a directory"""
+    paths = []
+    for path in sorted(glob(os.path.join(cruise_dir, '*'))):
+        if os.path.splitext(path)[1].lower() in CTD_EXTENSIONS:
+            paths.append(path)
+    return paths
+
+
+def _hdr_result(df, path, output_dir):
+    row = df.iloc[0]
+    return { 'date': row['date'], 'latitude': row['latitude'], 'longitude': row['longitude'] }
+
+
+def _btl_result(df, path, output_dir):
+    return { 'frame': df, 'rows': len(df) }
+
+
+def _asc_result(df, path, output_dir):
+    from .asc import DEPTH_COL
+    result = { 'rows': len(df) }
+    if DEPTH_COL in df.columns:
+        result['max_depth'] = df[DEPTH_COL].max()
+    if output_dir is not None:
+        base = os.path.splitext(os.path.basename(path))[0]
+        result['output'] = os.path.join(output_dir, f'{base}.parquet')
+        df.to_parquet(result['output'], index=False)
+    return result
+
+
+RESULTS = {
+    'hdr': _hdr_result,
+    'btl': _btl_result,
+    'asc': _asc_result,
+}
+
+
+def parse_ctd_file(path, output_dir=None, cache_dir=None, compact=False):
+    """parse one CTD file (or read it from the parse cache in cache_dir), timing it
+    and measuring the memory used by the parsed frame. runs in a worker process,
+    so errors are returned rather than raised"""
+    cruise, cast = parse_cast_filename(path)
+    kind = file_kind(path)
+    result = { 'path': path, 'type': kind, 'cruise': cruise, 'cast': cast, 'error': None, 'cached': False }
+    start = time.perf_counter()
+    try:
+        if cache_dir is None:
+            df = PARSERS[kind](path)
+        else:
+            cache = ParseCache(cache_dir)
+            df = cache.frame(path)
+            result['cached'] = cache.hits > 0
+        if compact:
+            df = compact_dtypes(df)
+        result['memory_bytes'] = memory_report(df)['total']
+        result.update(RESULTS[kind](df, path, output_dir))
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+class CompiledCruise(object):
+    """the results of compile_cruise.
+
+    btl is every bottle of the cruise, with cruise and cast columns; bottles is the
+    summary of it made by summarize_compiled_btl_files; casts has a row per cast
+    with the header time and position and the files found for it; timings has a
+    row per file with the time taken to parse it, the memory used by the
+    parsed frame and any error"""
+
+    timing_columns = ['path', 'type', 'cruise', 'cast', 'rows', 'seconds', 'memory_bytes', 'cached', 'error']
+
+    def __init__(self, results, compact=False):
+        self.timings = pd.DataFrame([
+            { k: r.get(k) for k in self.timing_columns } for r in results
+        ], columns=self.timing_columns)
+        ok = [r for r in results if r['error'] is None and r['cruise'] is not None]
+
+        frames = []
+        for r in ok:
+            if r['type'] == 'btl':
+                df = r['frame']
+                df.insert(0, 'cast', r['cast'])
+                df.insert(0, 'cruise', r['cruise'])
+                frames.append(df)
+        self.btl = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if compact and frames:
+            self.btl = compact_dtypes(self.btl)
+
+        self.casts = self._cast_index(ok)
+
+    @property
+    def bottles(self):
+        from .btl import summarize_compiled_btl_files
+        if self.btl.empty:
+            return pd.DataFrame(columns=['cruise','cast','niskin','date','latitude','longitude','depth'])
+        btl = self.btl.copy()
+        # summarize converts to float64, which would show float32 rounding error.
+        # compact float32 columns hold decimal values exactly, so go via their text
+        for c in btl.columns[btl.dtypes == 'float32']:
+            btl[c] = btl[c].astype(str).astype(float)
+        return summarize_compiled_btl_files(btl)
+
+    @staticmethod
+    def _cast_index(results):
+        casts = {}
+        for r in results:
+            row = casts.setdefault((r['cruise'], r['cast']), { 'cruise': r['cruise'], 'cast': r['cast'] })
+            row[f"{r['type']}_file"] = os.path.basename(r['path'])
+            if r['type'] == 'hdr':
+                row.update({ k: r[k] for k in ['date', 'latitude', 'longitude'] })
+            elif r['type'] == 'btl':
+                row['n_bottles'] = r['rows']
+            elif r['type'] == 'asc':
+                row['asc_rows'] = r['rows']
+                row['max_depth'] = r.get('max_depth')
+                if 'output' in r:
+                    row['asc_output'] = r['output']
+        columns = ['cruise', 'cast', 'date', 'latitude', 'longitude', 'n_bottles', 'asc_rows', 'max_depth',
+                   'hdr_file', 'btl_file', 'asc_file']
+        df = pd.DataFrame(list(casts.values()))
+        df = df.reindex(columns=columns + [c for c in df.columns if c not in columns])
+        df['date'] = pd.to_datetime(df['date'], utc=True)
+        df = df.sort_values(['cruise', 'cast'])
+        df.index = range(len(df))
+        return df
+
+
+def compile_cruise(cruise_dir, workers=None, output_dir=None, cache=True, compact=False):
+    """parse all the CTD files in a cruise directory across a pool of worker
+    processes. if output_dir is given, each parsed ASC file is written there as
+    parquet. with cache, parsed files are kept in (and, when unchanged, read back
+    from) a ParseCache in the cruise directory; cache may also be a ParseCache or
+    the path of a cache directory. with compact, parsed frames are downcast by compact_dtypes. returns a CompiledCruise"""
+    paths = find_ctd_files(cruise_dir)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    if cache is True:
+        cache = ParseCache.for_directory(cruise_dir)
+    elif isinstance(cache, str):
+        cache = ParseCache(cache)
+    cache_dir = cache.cache_dir if cache else None
+
+    # files that are already cached are quick to read here, only parse the rest in parallel
+    cached = [p for p in paths if cache and p in cache]
+    results = [parse_ctd_file(p, output_dir, cache_dir, compact) for p in cached]
+    paths = [p for p in paths if p not in cached]
+
+    if workers == 1 or len(paths) <= 1:
+        results += [parse_ctd_file(p, output_dir, cache_dir, compact) for p in paths]
+    else:
+        # spawn rather than fork, as this may run inside a threaded server
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn')) as pool:
+            n = len(paths)
+            results += list(pool.map(parse_ctd_file, paths, [output_dir] * n, [cache_dir] * n, [compact] * n))
+
+    if cache:
+        cache.hits += sum(1 for r in results if r['cached'])
+        cache.misses += sum(1 for r in results if not r['cached'])
+    results.sort(key=lambda r: r['path'])
+    return CompiledCruise(results, compact=compact)
@@ -1,10 +1,10 @@
-import re
 import os
 from glob import glob
 
 import pandas as pd
 
-from .common import CtdTextParser
+from api.metrics import count_parsed
+from .common import CtdTextParser, parse_cast_filename
 
 class HdrFile(CtdTextParser):
     def __init__(self, **kw):
@@ -12,45 +12,33 @@ class HdrFile(CtdTextParser):
     def parse(self):
         super(HdrFile, self).parse()
         self._parse_names()
-    def _read_lines(self):
-        self._lines = []
-        with open(self.data, 'r', encoding='latin-1') as fin:
-            for l in fin.readlines():
-                if not l.startswith('*END*'):
-                    self._lines.append(l.rstrip())
+        count_parsed('hdr', self.path if self.data is None else self.data)
     def _parse_names(self):
-        REGEX = r'# name \d+ = ([^:]+): ([^\[]+)(?:\[(.*)\](, .*)?)?'
-        names, defns, units, params = [], {}, {}, {}
-        for line in self._lines:
-            if not re.search(r'^# name \d+', line):
-                continue
-            name, defn, unit, param = re.match(REGEX, line).groups()
-            defn = defn.rstrip() # FIXME do in regex?
-            if param is not None:
-                param = param.lstrip(', ') # FIXME do in regex?
-            names.append(name)
-            defns[name] = defn
-            units[name] = unit
-            params[name] = params
-        self.names = names
-        self.definitions = defns
-        self.units = units
-        self._params = params
+        # names are read along with the rest of the header
+        self.names = self.header.names
+        self.definitions = self.header.definitions
+        self.units = self.header.units
+        self._params = self.header.params
     ## accessors
     def definition(self, name):
         return self.definitions[name]
     def units(self, name):
         return self.units[name]
 
-def compile_hdr_files(hdr_dir):
+def compile_hdr_files(hdr_dir, cache=None):
+    """time and position of every .hdr file in a directory. with a ParseCache,
+    only new or changed files are parsed"""
+    from .cache import hdr_frame
     cruises, casts, times, lats, lons = [], [], [], [], []
     for path in glob(os.path.join(hdr_dir, '*.hdr')):
-        hf = HdrFile(path)
-        cruises.append(hf.cruise)
-        casts.append(hf.cast)
-        times.append(hf.time)
-        lats.append(hf.lat)
-        lons.append(hf.lon)
+        hf = (cache.frame(path) if cache is not None else hdr_frame(path)).iloc[0]
+        # HdrFile doesn't know its cruise and cast, they're in the file name
+        cruise, cast = parse_cast_filename(path)
+        cruises.append(cruise)
+        casts.append(cast)
+        times.append(hf['date'])
+        lats.append(hf['latitude'])
+        lons.append(hf['longitude'])
     df = pd.DataFrame({
         'cruise': cruises,
         'cast': casts,
@@ -65,4 +53,3 @@ def compile_hdr_files(hdr_dir):
     df = df.sort_values('cast')
     df.index = range(len(df))
     return df
-    
@@ -0,0 +1,186 @@
+# streaming responses for DataFrames
+
+import io
+import re
+import zlib
+
+import pandas as pd
+
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+# rows of a DataFrame rendered per streamed chunk
+CSV_CHUNK_ROWS = 10000
+
+
+def accepts_gzip(request):
+    """whether the request's Accept-Encoding allows gzip (with a nonzero q)"""
+    if request is None:
+        return False
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.strip().partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        match = re.search(r'q=([0-9.]+)', params)
+        if match is None or float(match.group(1)) > 0:
+            return True
+    return False
+
+
+def gzip_chunks(chunks):
+    """gzip-compress an iterable of bytes, yielding compressed chunks as they fill"""
+    compressor = zlib.compressobj(wbits=31) # 31 = gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def csv_chunks(frames, chunk_rows=CSV_CHUNK_ROWS):
+    """render a DataFrame, or an iterable of DataFrames with the same columns,
+    as one CSV document in chunks of at most chunk_rows rows"""
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    header = True
+    for df in frames:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk = df.iloc[start:start + chunk_rows]
+            if len(chunk) == 0 and not header:
+                continue
+            yield chunk.to_csv(index=False, header=header).encode('utf-8')
+            header = False
+
+
+def streaming_response(chunks, content_type, filename, request=None):
+    """stream an iterable of bytes as an attachment, gzipped if the client accepts it"""
+    gzip = accepts_gzip(request)
+    if gzip:
+        chunks = gzip_chunks(chunks)
+
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename={filename}'
+    response['Vary'] = 'Accept-Encoding'
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
+
+    return response
+
+
+def csv_response(frames, filename, request=None):
+    # Send it as a response, a chunk at a time
+    return streaming_response(csv_chunks(frames), 'text/csv', filename, request)
+
+
+class _DrainingSink(io.RawIOBase):
+    """write-only file that hands back what has been written since it was
+    last drained, while reporting the total bytes written as its position"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._position += len(b)
+        return len(b)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def arrow_chunks(frames, output_format):
+    """render a DataFrame, or an iterable of DataFrames with the same columns, as one
+    parquet file (a row group per DataFrame), Arrow IPC stream or Feather (Arrow IPC
+    file), yielding bytes as each DataFrame is written"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    sink = _DrainingSink()
+    writer = schema = None
+
+    for df in frames:
+        if writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            schema = table.schema
+            if output_format == 'parquet':
+                writer = pq.ParquetWriter(sink, schema)
+            elif output_format == 'arrow':
+                writer = pa.ipc.new_stream(sink, schema)
+            else:
+                writer = pa.ipc.new_file(sink, schema)
+        else:
+            # later chunks are converted to the schema of the first
+            table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        writer.write_table(table)
+        yield sink.drain()
+
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+class DataFrameRenderer(BaseRenderer):
+    """lets DRF content negotiation (Accept header or ?format=) choose the format of
+    a DataFrame response; views then stream the data with dataframe_response.
+    anything else rendered through it, such as error messages, is sent as JSON"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = 'application/json'
+        return JSONRenderer().render(data)
+
+class CSVRenderer(DataFrameRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+class ParquetRenderer(DataFrameRenderer):
+    media_type = 'application/vnd.apache.parquet'
+    format = 'parquet'
+
+class ArrowRenderer(DataFrameRenderer):
+    media_type = 'application/vnd.apache.arrow.stream'
+    format = 'arrow'
+
+class FeatherRenderer(DataFrameRenderer):
+    media_type = 'application/vnd.apache.arrow.file'
+    format = 'feather'
+
+# CSV comes first, so it remains the default
+DATAFRAME_RENDERERS = [CSVRenderer, ParquetRenderer, ArrowRenderer, FeatherRenderer, JSONRenderer]
+
+DATAFRAME_FORMATS = {
+    r.format: r.media_type for r in [ParquetRenderer, ArrowRenderer, FeatherRenderer]
+}
+
+
+def dataframe_format(request):
+    """the DataFrame output format negotiated for a request: csv, parquet, arrow or feather"""
+    renderer = getattr(request, 'accepted_renderer', None)
+    output_format = getattr(renderer, 'format', 'csv')
+    return output_format if output_format in DATAFRAME_FORMATS else 'csv'
+
+
+def dataframe_response(frames, basename, request):
+    """respond with a DataFrame (or an iterable of DataFrames) in the negotiated format"""
+    output_format = dataframe_format(request)
+    if output_format == 'csv':
+        response = csv_response(frames, f'{basename}.csv', request)
+    else:
+        response = streaming_response(arrow_chunks(frames, output_format), DATAFRAME_FORMATS[output_format],
+                                      f'{basename}.{output_format}', request)
+    # the format is negotiated from ?format= or the Accept header
+    patch_vary_headers(response, ['Accept'])
+    return response
@@ -1,4 +1,4 @@
-from rest_framework.serializers import HyperlinkedModelSerializer, RelatedField, FloatField, CharField, SerializerMethodField
+from rest_framework.serializers import HyperlinkedModelSerializer, RelatedField, FloatField, CharField, DateTimeField, SerializerMethodField
 
 from api.models import Station, StationLocation
 
@@ -13,6 +13,47 @@ class GeolocatedObjectRelatedField(RelatedField):
 
         return serializer.data
 
+
+class FlatStationLocationField(RelatedField):
+    """renders a StationLocation in the same shape as StationLocationSerializer,
+    but without instantiating a serializer per location. if the location was
+    fetched with latitude/longitude annotations, its geometry is not needed"""
+
+    datetime_field = DateTimeField()
+
+    def to_representation(self, value):
+        if not isinstance(value, StationLocation):
+            raise Exception('Unexpected type of geolocated object')
+
+        if hasattr(value, 'latitude'):
+            latitude, longitude = value.latitude, value.longitude
+        else:
+            latitude, longitude = value.geolocation.y, value.geolocation.x
+
+        end_time = value.end_time
+        return {
+            'id': value.id,
+            'geolocation': {
+                'latitude': latitude,
+                'longitude': longitude
+            },
+            'depth': value.depth,
+            'start_time': self.datetime_field.to_representation(value.start_time),
+            'end_time': self.datetime_field.to_representation(end_time) if end_time is not None else None,
+            'comment': value.comment
+        }
+
+
+class DynamicFieldsMixin(object):
+    """takes an additional `fields` argument restricting which fields are rendered"""
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super(DynamicFieldsMixin, self).__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
 class GeolocationField(RelatedField):
 
     def to_representation(self, value):
@@ -24,8 +65,8 @@ class GeolocationField(RelatedField):
         }
     
 
-class StationSerializer(HyperlinkedModelSerializer):
-    locations = GeolocatedObjectRelatedField(many=True, read_only=True)
+class StationSerializer(DynamicFieldsMixin, HyperlinkedModelSerializer):
+    locations = FlatStationLocationField(many=True, read_only=True)
 
     class Meta:
         model = Station
@@ -1,3 +1,434 @@
-from django.test import TestCase
+import math
+from io import BytesIO
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+
+from django.test import SimpleTestCase, TestCase
+
+from api.geo import nearest_locations
+from api.index import LocationIndex, location_table_version
+from api.models import Station
+from api.parsers.ctd.asc import parse_asc
+from api.parsers.ctd.btl import BtlFile
+from api.parsers.ctd.common import p_to_z
+from api.parsers.ctd.hdr import HdrFile
+from api.workflows import import_station_list, station_list_locations
+
+# a small Sea-Bird header, shared by the .hdr and .btl fixtures
+CTD_HEADER = """* Sea-Bird SBE 9 Data File:
+* FileName = C:\\data\\EN627\\EN627_001.hex
+* NMEA Latitude = 41 11.52 N
+* NMEA Longitude = 070 53.04 W
+* NMEA UTC (Time) = Oct 21 2019 00:15:01
+* System UTC = Oct 21 2019 00:15:09
+** Cruise: EN627
+# nquan = 4
+# name 0 = prDM: Pressure, Digiquartz [db]
+# name 1 = t090C: Temperature [ITS-90, deg C]
+# name 2 = sal00: Salinity, Practical [PSU]
+# name 3 = sbeox0V: Oxygen raw, SBE 43 [V], offset = 0.0
+# file_type = ascii
+*END*
+"""
+
+# bottle rows with depth, latitude and longitude columns, each as its
+# average, standard deviation, min and max lines
+BTL_COLUMNS = """    Bottle        Date       PrDM      DepSM      T090C      Sal00   Latitude  Longitude
+  Position        Time
+"""
+BTL_ROWS = [
+    """      1    Oct 21 2019    64.4115    64.0592    12.8933    32.7741    41.1920   -70.8840 (avg)
+              00:16:08     0.0064     0.0064     0.0013     0.0033     0.0041     0.0071 (sdev)
+                          64.4015    64.0492    12.8833    32.7641    41.1820   -70.8940 (min)
+                          64.4215    64.0692    12.9033    32.7841    41.2020   -70.8740 (max)
+""",
+    """      2    Oct 21 2019    27.8613    27.7089    15.7565    32.0636    41.1921   -70.8841 (avg)
+              00:17:15     0.0028     0.0028     0.0016     0.0032     0.0041     0.0071 (sdev)
+                          27.8513    27.6989    15.7465    32.0536    41.1821   -70.8941 (min)
+                          27.8713    27.7189    15.7665    32.0736    41.2021   -70.8741 (max)
+""",
+    """      3    Nov 01 2019     5.0842     5.0564    17.6007    31.6142    41.1920   -70.8839 (avg)
+              23:59:59     0.0005     0.0005     0.0018     0.0032     0.0041     0.0071 (sdev)
+                           5.0742     5.0464    17.5907    31.6042    41.1820   -70.8939 (min)
+                           5.0942     5.0664    17.6107    31.6242    41.2020   -70.8739 (max)
+""",
+]
+
+
+def btl_text(minmax=True, columns=None):
+    """the .btl fixture, optionally without its min/max lines or restricted
+    to some of its value columns"""
+    lines = (BTL_COLUMNS + ''.join(BTL_ROWS)).splitlines()
+    if not minmax:
+        lines = [l for l in lines if not l.endswith(('(min)', '(max)'))]
+    if columns is not None:
+        names = ['PrDM', 'DepSM', 'T090C', 'Sal00', 'Latitude', 'Longitude']
+        keep = [names.index(c) for c in columns]
+        def select(line):
+            suffix = line[22 + 11 * len(names):]
+            return line[:22] + ''.join(line[22 + 11 * i:33 + 11 * i] for i in keep) + suffix
+        lines = [select(l) for l in lines]
+    return CTD_HEADER + '\n'.join(lines) + '\n'
+
+
+def as_buffer(text):
+    # Sea-Bird software writes latin-1 with CRLF line endings
+    return BytesIO(text.replace('\n', '\r\n').encode('latin-1'))
+
+
+def an69_depth(p, latitude):
+    # Sea-Bird application note 69, one scalar at a time
+    x = math.pow(math.sin(latitude / 57.29578), 2)
+    g = 9.780318 * (1.0 + (5.2788e-3 + 2.36e-5 * x) * x) + 1.092e-6 * p
+    return ((((-1.82e-15 * p + 2.279e-10) * p - 2.2512e-5) * p + 9.72659) * p) / g
+
+
+class BtlFileTests(SimpleTestCase):
+
+    def expected(self):
+        return pd.DataFrame({
+            'niskin': [1, 2, 3],
+            'date': pd.to_datetime(['2019-10-21 00:16:08', '2019-10-21 00:17:15', '2019-11-01 23:59:59'], utc=True),
+            'prdm': [64.4115, 27.8613, 5.0842],
+            'depsm': [64.0592, 27.7089, 5.0564],
+            't090c': [12.8933, 15.7565, 17.6007],
+            'sal00': [32.7741, 32.0636, 31.6142],
+            'latitude': [41.1920, 41.1921, 41.1920],
+            'longitude': [-70.8840, -70.8841, -70.8839],
+        })
+
+    def test_with_min_max(self):
+        df = BtlFile(buffer=as_buffer(btl_text(minmax=True))).to_dataframe()
+        pd.testing.assert_frame_equal(df, self.expected())
+
+    def test_without_min_max(self):
+        df = BtlFile(buffer=as_buffer(btl_text(minmax=False))).to_dataframe()
+        pd.testing.assert_frame_equal(df, self.expected())
+
+    def test_header(self):
+        btl = BtlFile(buffer=as_buffer(btl_text()))
+        self.assertEqual(btl.time, pd.Timestamp('2019-10-21 00:15:01', tz='UTC'))
+        self.assertAlmostEqual(btl.lat, 41.192)
+        self.assertAlmostEqual(btl.lon, -70.884)
+
+    def test_depth_and_position_from_header(self):
+        # without depth, latitude and longitude columns, depth comes from pressure
+        # and the position from the header
+        for minmax in (True, False):
+            btl = BtlFile(buffer=as_buffer(btl_text(minmax=minmax, columns=['PrDM', 'T090C'])))
+            df = btl.to_dataframe()
+            self.assertEqual(list(df.columns), ['niskin', 'date', 'prdm', 't090c', 'depsm', 'latitude', 'longitude'])
+            np.testing.assert_allclose(df['depsm'], [an69_depth(p, btl.lat) for p in df['prdm']], rtol=1e-12)
+            self.assertTrue((df['latitude'] == btl.lat).all())
+            self.assertTrue((df['longitude'] == btl.lon).all())
+
+    def test_compact(self):
+        btl = BtlFile(buffer=as_buffer(btl_text()))
+        df = btl.to_dataframe()
+        full_size = btl.memory_report()['total']
+        compact = btl.to_dataframe(compact=True)
+        # the frame returned earlier is left as it was
+        pd.testing.assert_frame_equal(df, self.expected())
+        self.assertEqual(compact['prdm'].dtype, np.float32)
+        np.testing.assert_array_equal(compact['prdm'].astype(float).round(4), df['prdm'])
+        self.assertIs(btl.to_dataframe(), compact)
+        self.assertLess(btl.memory_report()['total'], full_size)
+
+
+class HdrFileTests(SimpleTestCase):
+
+    def test_header(self):
+        hdr = HdrFile(buffer=as_buffer(CTD_HEADER))
+        # the NMEA time is preferred to the system time
+        self.assertEqual(hdr.time, pd.Timestamp('2019-10-21 00:15:01', tz='UTC'))
+        self.assertAlmostEqual(hdr.lat, 41.192)
+        self.assertAlmostEqual(hdr.lon, -70.884)
+
+    def test_names(self):
+        hdr = HdrFile(buffer=as_buffer(CTD_HEADER))
+        self.assertEqual(hdr.names, ['prDM', 't090C', 'sal00', 'sbeox0V'])
+        self.assertEqual(hdr.definitions, {
+            'prDM': 'Pressure, Digiquartz',
+            't090C': 'Temperature',
+            'sal00': 'Salinity, Practical',
+            'sbeox0V': 'Oxygen raw, SBE 43',
+        })
+        self.assertEqual(hdr.units, { 'prDM': 'db', 't090C': 'ITS-90, deg C', 'sal00': 'PSU', 'sbeox0V': 'V' })
+        self.assertEqual(hdr.definition('t090C'), 'Temperature')
+
+    def test_system_time(self):
+        text = CTD_HEADER.replace('* NMEA UTC (Time) = Oct 21 2019 00:15:01\n', '')
+        hdr = HdrFile(buffer=as_buffer(text))
+        self.assertEqual(hdr.time, pd.Timestamp('2019-10-21 00:15:09', tz='UTC'))
+
+
+class DepthTests(SimpleTestCase):
+
+    def test_p_to_z_matches_an69(self):
+        pressures = np.linspace(0, 6000, 601)
+        for latitude in (-90.0, -41.5, 0.0, 12.25, 41.192, 90.0):
+            expected = [an69_depth(p, latitude) for p in pressures]
+            np.testing.assert_allclose(p_to_z(pressures, latitude), expected, rtol=1e-12, atol=1e-9)
+
+    def test_p_to_z_latitude_array(self):
+        pressures = np.array([0.0, 10.0, 500.0, 5000.0])
+        latitudes = np.array([0.0, 30.0, 41.192, -70.0])
+        expected = [an69_depth(p, lat) for p, lat in zip(pressures, latitudes)]
+        np.testing.assert_allclose(p_to_z(pressures, latitudes), expected, rtol=1e-12)
+
+    def test_p_to_z_scalar(self):
+        depth = p_to_z(1000.0, 41.192)
+        self.assertIsInstance(depth, float)
+        self.assertAlmostEqual(depth, an69_depth(1000.0, 41.192), places=9)
+
+    def asc_buffer(self):
+        return BytesIO(b'PrDM,T090C,Latitude\n10.0,12.5,41.1\n250.5,10.1,41.2\n')
+
+    def test_asc_depth_is_opt_in(self):
+        df = parse_asc(self.asc_buffer())
+        self.assertEqual(list(df.columns), ['prdm', 't090c', 'latitude'])
+
+    def test_asc_depth(self):
+        df = parse_asc(self.asc_buffer(), depth=True)
+        np.testing.assert_allclose(df['depsm'], [an69_depth(10.0, 41.1), an69_depth(250.5, 41.2)], rtol=1e-12)
+        # a latitude for the whole cast takes precedence over the latitude column
+        df = parse_asc(self.asc_buffer(), depth=True, latitude=40.0)
+        np.testing.assert_allclose(df['depsm'], [an69_depth(10.0, 40.0), an69_depth(250.5, 40.0)], rtol=1e-12)
+
+
+class LocationIndexTests(SimpleTestCase):
+    """LocationIndex.nearest against brute force (geo.nearest_locations)"""
+
+    T0 = pd.Timestamp('2020-01-01', tz='UTC')
+
+    def locations(self):
+        # A moves once and B twice; B is gone for a while in between, C only
+        # exists for a day and D is added last, with no end
+        t = lambda days: self.T0 + pd.Timedelta(days=days)
+        rows = [
+            ('A', 40.0, -71.0, t(0), t(10)),
+            ('A', 40.1, -71.1, t(10), pd.NaT),
+            ('B', 40.5, -70.5, t(2), t(5)),
+            ('B', 40.4, -70.6, t(8), t(12)),
+            ('B', 40.6, -70.4, t(12), pd.NaT),
+            ('C', 40.05, -71.05, t(5), t(6)),
+            ('D', 41.0, -70.0, t(20), pd.NaT),
+        ]
+        df = pd.DataFrame(rows, columns=['station', 'latitude', 'longitude', 'start_time', 'end_time'])
+        df.insert(0, 'id', np.arange(1, len(df) + 1))
+        return df
+
+    def query_times(self, locations):
+        # every boundary, a nanosecond either side of it, and times in between
+        ns = pd.Timedelta(1, 'ns')
+        boundaries = pd.concat([locations['start_time'], locations['end_time'].dropna()]).unique()
+        times = []
+        for b in boundaries:
+            times += [b - ns, b, b + ns]
+        times += [self.T0 - pd.Timedelta(days=365), self.T0 + pd.Timedelta(days=7), self.T0 + pd.Timedelta(days=3650)]
+        return pd.DatetimeIndex(times).as_unit('ns').asi8
+
+    def assert_same_as_brute_force(self, locations, latitudes, longitudes, times):
+        index = LocationIndex(locations)
+        ix, distance_m = index.nearest(latitudes, longitudes, times)
+        expected_ix, expected_m = nearest_locations(latitudes, longitudes, times, locations)
+        np.testing.assert_array_equal(ix, expected_ix)
+        np.testing.assert_allclose(distance_m, expected_m, rtol=1e-9)
+        return ix
+
+    def test_matches_brute_force(self):
+        locations = self.locations()
+        times = self.query_times(locations)
+        rng = np.random.default_rng(0)
+        n = 50
+        latitudes = rng.uniform(39.5, 41.5, n * len(times))
+        longitudes = rng.uniform(-71.5, -69.5, n * len(times))
+        ix = self.assert_same_as_brute_force(locations, latitudes, longitudes, np.repeat(times, n))
+        # every location is the nearest one somewhere
+        self.assertEqual(set(ix[ix >= 0]), set(range(len(locations))))
+
+    def test_boundaries(self):
+        locations = self.locations()
+        ns = pd.Timedelta(1, 'ns')
+        t = lambda days: (self.T0 + pd.Timedelta(days=days)).value
+        # right next to C, which is valid from day 5 to day 6 inclusive
+        lat, lon = np.full(4, 40.05), np.full(4, -71.05)
+        times = np.array([t(5) - ns.value, t(5), t(6), t(6) + ns.value])
+        ix = self.assert_same_as_brute_force(locations, lat, lon, times)
+        self.assertEqual(list(locations['station'].to_numpy()[ix]), ['A', 'C', 'C', 'A'])
+
+    def test_gap(self):
+        # B's own position while it has no location, on day 6
+        locations = self.locations()
+        times = np.array([(self.T0 + pd.Timedelta(days=6, hours=12)).value])
+        ix = self.assert_same_as_brute_force(locations, np.array([40.5]), np.array([-70.5]), times)
+        self.assertEqual(locations['station'].iloc[ix[0]], 'A')
+
+    def test_before_history(self):
+        locations = self.locations()
+        times = np.full(3, (self.T0 - pd.Timedelta(days=1)).value)
+        ix = self.assert_same_as_brute_force(locations, np.array([40.0, 0.0, -89.0]),
+                                             np.array([-71.0, 0.0, 179.0]), times)
+        self.assertTrue((ix == -1).all())
+
+    def test_empty(self):
+        locations = self.locations().iloc[:0]
+        ix, distance_m = LocationIndex(locations).nearest(np.array([40.0]), np.array([-71.0]),
+                                                          np.array([self.T0.value]))
+        self.assertEqual(list(ix), [-1])
+        self.assertTrue(np.isnan(distance_m).all())
+
+    def test_k_nearest(self):
+        # the k nearest, in order, are the ones brute force finds by dropping
+        # each nearest location in turn
+        locations = self.locations()
+        times = self.query_times(locations)
+        rng = np.random.default_rng(1)
+        latitudes = rng.uniform(39.5, 41.5, len(times))
+        longitudes = rng.uniform(-71.5, -69.5, len(times))
+        ix, distance_m = LocationIndex(locations).nearest(latitudes, longitudes, times, k=3)
+        for i in range(len(times)):
+            remaining = locations
+            for j in range(3):
+                expected_ix, expected_m = nearest_locations(latitudes[i:i+1], longitudes[i:i+1], times[i:i+1], remaining)
+                if expected_ix[0] < 0:
+                    self.assertEqual(ix[i, j], -1)
+                    break
+                row = remaining.index[expected_ix[0]]
+                self.assertEqual(ix[i, j], row)
+                self.assertAlmostEqual(distance_m[i, j], expected_m[0], places=3)
+                remaining = remaining.drop(row)
+
+
+STATION_LIST_COLUMNS = ['station', 'decimalLatitude', 'decimalLongitude', 'depth_m', 'startDate', 'endDate', 'comment']
+
+
+def station_list(rows):
+    return pd.DataFrame(rows, columns=STATION_LIST_COLUMNS)
+
+
+class StationListLocationsTests(SimpleTestCase):
+
+    def test_chaining(self):
+        df = station_list([
+            ('L2', 40.2, -70.9, 50, '2021-01-01', None, 'moved'),
+            ('L1', 40.0, -71.0, 30, '2020-01-01', 'current', None),
+            ('L2', 40.1, -70.8, 45, '2020-01-01', '2020-06-01', None),
+            ('L2', 40.3, -70.7, 55, '2022-01-01', None, None),
+            ('L3', 40.5, -70.5, 10, 'current', None, 'not deployed'),
+        ])
+        locations = station_list_locations(df)
+        self.assertEqual(list(locations['station']), ['L1', 'L2', 'L2', 'L2'])
+        ts = lambda s: pd.Timestamp(s, tz='UTC')
+        self.assertEqual(list(locations['start_time']),
+                         [ts('2020-01-01'), ts('2020-01-01'), ts('2021-01-01'), ts('2022-01-01')])
+        # explicit end times are kept, open ones end where the next location starts
+        end_times = list(locations['end_time'])
+        self.assertTrue(pd.isnull(end_times[0]))
+        self.assertEqual(end_times[1:3], [ts('2020-06-01'), ts('2022-01-01')])
+        self.assertTrue(pd.isnull(end_times[3]))
+        self.assertEqual([c if pd.notnull(c) else None for c in locations['comment']], [None, None, 'moved', None])
+
+    def assert_invalid(self, rows, message):
+        with self.assertRaisesRegex(ValueError, message):
+            station_list_locations(station_list(rows))
+
+    def test_identical_start_and_end(self):
+        self.assert_invalid([('L1', 40.0, -71.0, 30, '2020-01-01', '2020-01-01', None)],
+                            'must not be identical')
+
+    def test_end_before_start(self):
+        self.assert_invalid([('L1', 40.0, -71.0, 30, '2020-01-02', '2020-01-01', None)],
+                            'greater than or equal to start_time')
+
+    def test_duplicate_start(self):
+        self.assert_invalid([
+            ('L1', 40.0, -71.0, 30, '2020-01-01', None, None),
+            ('L1', 40.1, -71.1, 30, '2020-01-01', None, None),
+        ], 'already exists')
+
+    def test_overlaps_successor(self):
+        self.assert_invalid([
+            ('L1', 40.0, -71.0, 30, '2020-01-01', '2020-03-01', None),
+            ('L1', 40.1, -71.1, 30, '2020-02-01', None, None),
+        ], 'successor')
+        # ending exactly where the successor starts is fine
+        station_list_locations(station_list([
+            ('L1', 40.0, -71.0, 30, '2020-01-01', '2020-02-01', None),
+            ('L1', 40.1, -71.1, 30, '2020-02-01', None, None),
+        ]))
+
+    def test_invalid_position_depth_and_time(self):
+        self.assert_invalid([('L1', 91.0, -71.0, 30, '2020-01-01', None, None)], 'Invalid latitude/longitude')
+        self.assert_invalid([('L1', 40.0, -71.0, -1, '2020-01-01', None, None)], 'Negative depth')
+        self.assert_invalid([('L1', 40.0, -71.0, 30, 'yesterday', None, None)], 'Invalid startDate')
+
+
+class ImportStationListTests(TestCase):
+
+    def rows(self):
+        return [
+            ('L1', 40.0, -71.0, 30, '2020-01-01', None, None),
+            ('L1', 40.1, -71.1, 35, '2021-01-01', None, None),
+            ('L2', 40.5, -70.5, 50, '2020-01-01', None, None),
+            ('L3', 40.7, -70.3, 60, '2020-01-01', None, None),
+        ]
+
+    def stored(self, name):
+        return [(round(l.geolocation.y, 6), round(l.geolocation.x, 6), l.depth, l.start_time, l.end_time)
+                for l in Station.objects.get(name=name).locations.order_by('start_time')]
+
+    def test_import(self):
+        version = location_table_version()
+        counts = import_station_list(station_list(self.rows()))
+        self.assertEqual(counts, { 'created': 3, 'updated': 0, 'unchanged': 0 })
+        self.assertEqual(location_table_version(), version + 1)
+        self.assertEqual(sorted(Station.objects.values_list('name', flat=True)), ['L1', 'L2', 'L3'])
+        ts = lambda s: pd.Timestamp(s, tz='UTC')
+        self.assertEqual(self.stored('L1'), [
+            (40.0, -71.0, 30, ts('2020-01-01'), ts('2021-01-01')),
+            (40.1, -71.1, 35, ts('2021-01-01'), None),
+        ])
+
+        # a full import replaces every station
+        counts = import_station_list(station_list(self.rows()[2:3]))
+        self.assertEqual(counts, { 'created': 1, 'updated': 0, 'unchanged': 0 })
+        self.assertEqual(list(Station.objects.values_list('name', flat=True)), ['L2'])
+
+    def test_update(self):
+        import_station_list(station_list(self.rows()))
+        l2_ids = list(Station.objects.get(name='L2').locations.values_list('id', flat=True))
+        version = location_table_version()
+
+        rows = self.rows()
+        rows[1] = ('L1', 40.1, -71.1, 40, '2021-01-01', None, None) # new depth
+        rows += [
+            ('L4', 41.0, -70.0, 20, '2023-01-01', None, None),
+            ('L5', 41.1, -70.1, 25, None, None, 'not yet deployed'),
+        ]
+        del rows[3] # L3 is left out
+        counts = import_station_list(station_list(rows), update=True)
+        self.assertEqual(counts, { 'created': 2, 'updated': 1, 'unchanged': 1 })
+        self.assertEqual(location_table_version(), version + 1)
+
+        self.assertEqual([l[2] for l in self.stored('L1')], [30, 40])
+        # unchanged stations keep their locations, and stations not in the list stay
+        self.assertEqual(list(Station.objects.get(name='L2').locations.values_list('id', flat=True)), l2_ids)
+        self.assertEqual(len(self.stored('L3')), 1)
+        self.assertEqual(len(self.stored('L4')), 1)
+        # listed only on a row without a startDate, so it has no locations
+        self.assertEqual(self.stored('L5'), [])
+
+        # listing a station without any startDate clears its locations
+        counts = import_station_list(station_list([('L2', 40.5, -70.5, 50, None, None, None)]), update=True)
+        self.assertEqual(counts, { 'created': 0, 'updated': 1, 'unchanged': 0 })
+        self.assertEqual(self.stored('L2'), [])
+
+    def test_invalid_list_changes_nothing(self):
+        import_station_list(station_list(self.rows()))
+        rows = self.rows() + [('L1', 40.0, -71.0, 30, '2020-01-01', None, None)]
+        with self.assertRaises(ValueError):
+            import_station_list(station_list(rows), update=True)
+        self.assertEqual(Station.objects.count(), 3)
+        self.assertEqual(len(self.stored('L1')), 2)
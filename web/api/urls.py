@@ -21,4 +21,9 @@ urlpatterns = [
     path('parse-ctd-btl/', views.ParseBtlFile.as_view(), name='parse-ctd-btl'),
     path('parse-ctd-asc/', views.ParseAscFile.as_view(), name='parse-ctd-asc'),
     path('station-list', views.StationList.as_view(), name='station-list'),
+    path('compile-cruise/', views.CompileCruise.as_view(), name='compile-cruise'),
+    path('jobs/<str:kind>/', views.SubmitJob.as_view(), name='submit-job'),
+    path('jobs/<str:job_id>/status/', views.JobStatus.as_view(), name='job-status'),
+    path('jobs/<str:job_id>/result/', views.JobResult.as_view(), name='job-result'),
+    path('metrics', views.Metrics.as_view(), name='metrics'),
 ]
\ No newline at end of file
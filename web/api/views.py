@@ -1,36 +1,86 @@
-from io import StringIO, BytesIO
+import os
+import json
+import hashlib
+import itertools
 
 import pandas as pd
 
-from django.http import Http404, HttpResponse, JsonResponse
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, JsonResponse
+from django.urls import reverse
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.utils import timezone
 from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 
 from rest_framework import viewsets, permissions
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.authentication import TokenAuthentication
+from rest_framework.parsers import BaseParser, JSONParser, FormParser, MultiPartParser
+from rest_framework.exceptions import ParseError
+from rest_framework.pagination import CursorPagination
 
-from api.models import Station, StationLocation
+from api.models import Station, StationLocation, Latitude, Longitude
 from api.serializers import StationSerializer, StationLocationWithDistanceSerializer
 from api.utils import parse_datetime, parse_datetime_utc
 from api.parsers.ctd.hdr import HdrFile
 from api.parsers.ctd.btl import BtlFile
 from api.parsers.ctd.asc import parse_asc
 
-from api.workflows import add_nearest_station, station_list
+from api.workflows import add_nearest_station, nearest_stations, station_list
+from api.index import epoch_cache_key
+from api.instrumentation import stage
+from api.metrics import count_cache_lookups, exposition
+from api.responses import accepts_gzip, dataframe_format, dataframe_response, DATAFRAME_FORMATS, DATAFRAME_RENDERERS
+from api import jobs
+
+
+class StationCursorPagination(CursorPagination):
+
+    ordering = 'name'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
 
 
 class StationViewSet(viewsets.ModelViewSet):
 
     queryset = Station.objects.all()
     serializer_class = StationSerializer
+    pagination_class = StationCursorPagination
 
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
     lookup_field = 'name'
+
+    def requested_fields(self):
+        # optional ?fields=name,locations projection
+        fields = self.request.query_params.get('fields', None)
+        if not fields:
+            return None
+        return [f.strip() for f in fields.split(',') if f.strip()]
+
+    def get_queryset(self):
+        queryset = Station.objects.all()
+        fields = self.requested_fields()
+        if fields is None or 'locations' in fields:
+            # fetch all locations of the page in one query, with coordinates
+            # as plain floats instead of geometries
+            locations = StationLocation.objects.annotate(
+                latitude=Latitude('geolocation'),
+                longitude=Longitude('geolocation')
+            ).defer('geolocation').order_by('start_time')
+            queryset = queryset.prefetch_related(Prefetch('locations', queryset=locations))
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.requested_fields())
+        return super(StationViewSet, self).get_serializer(*args, **kwargs)
     
     def create(self, request, *args, **kwargs):
         station_name = request.data.get('name')
@@ -111,9 +161,22 @@ class AddStationLocation(APIView):
         return Response({"message": f"Location for station '{station_name}' added successfully."}, status=status.HTTP_201_CREATED)
 
 
+class NDJSONParser(BaseParser):
+    """newline-delimited JSON, one object per line"""
+
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return [json.loads(line) for line in stream if line.strip()]
+        except ValueError as e:
+            raise ParseError(f'NDJSON parse error - {e}')
+
+
 class NearestStationViewSet(viewsets.ModelViewSet):
 
     serializer_class = StationLocationWithDistanceSerializer
+    parser_classes = [JSONParser, NDJSONParser, FormParser, MultiPartParser]
 
     def get_queryset(self):
         
@@ -137,7 +200,11 @@ class NearestStationViewSet(viewsets.ModelViewSet):
         return [ Station.nearest_location(latitude, longitude, timestamp) ]
 
     def create(self, request):
-        
+
+        # a JSON array or NDJSON stream of points is a batch request
+        if isinstance(request.data, list):
+            return self.create_batch(request)
+
         # Extract data from request
         latitude = request.data.get('latitude')
         longitude = request.data.get('longitude')
@@ -161,22 +228,29 @@ class NearestStationViewSet(viewsets.ModelViewSet):
         # Serialize the result for the json response
         serializer = StationLocationWithDistanceSerializer(nearest_station)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
-        
 
-def csv_response(df, filename):
-    output = StringIO()
-    df.to_csv(output, index=False)
-    csv_content = output.getvalue()
+    def create_batch(self, request):
+        # number of nearest stations to return per point
+        try:
+            k = int(request.query_params.get('k', 1))
+        except ValueError:
+            return Response({"error": "k must be an integer."}, status=status.HTTP_400_BAD_REQUEST)
 
-    # Send it as a response
-    response = HttpResponse(csv_content, content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename={filename}'
-    
-    return response
+        if not all(isinstance(point, dict) for point in request.data):
+            return Response({"error": "Each point must be an object with latitude, longitude and timestamp."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            results = nearest_stations(request.data, k=k)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+        return Response(results, status=status.HTTP_201_CREATED)
+        
 
 class AddNearestStations(APIView):
 
+    renderer_classes = DATAFRAME_RENDERERS
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
@@ -192,7 +266,9 @@ class AddNearestStations(APIView):
         
         # Read input CSV using pandas
         try:
-            input_df = pd.read_csv(csv_file)
+            with stage('read_csv') as s:
+                input_df = pd.read_csv(csv_file)
+                s.rows = len(input_df)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         
@@ -203,7 +279,7 @@ class AddNearestStations(APIView):
                                             latitude_column=latitude_column,
                                             longitude_column=longitude_column)
 
-            return csv_response(output_df, 'nearest_station.csv')
+            return dataframe_response(output_df, 'nearest_station', request)
         except ValueError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except ValidationError as e:
@@ -211,13 +287,50 @@ class AddNearestStations(APIView):
 
           
 class StationList(APIView):
-    
+
+    renderer_classes = DATAFRAME_RENDERERS
+
+    # seconds to keep a rendered station list. entries are also superseded
+    # as soon as the location table is written
+    cache_timeout = 60 * 60
+
     def get(self, request):
         timestamp = request.GET.get('timestamp', None)
 
         try:
-            df = station_list(timestamp=timestamp)
-            return csv_response(df, 'station_list.csv')
+            if timestamp is None:
+                timestamp = timezone.now()
+            else:
+                timestamp = parse_datetime_utc(timestamp)
+                if timestamp is None:
+                    raise ValueError('Invalid timestamp format.')
+
+            # the list only changes when an interval boundary is crossed or the table is written
+            key = epoch_cache_key('station-list', timestamp)
+            cached = cache.get(key)
+            count_cache_lookups('station_list', hits=int(cached is not None), misses=int(cached is None))
+            if cached is None:
+                df = station_list(timestamp=timestamp)
+                # the ETag comes from a hash of the content, so it holds across
+                # restarts and however the table was written
+                digest = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()).hexdigest()
+                cached = (df, digest)
+                cache.set(key, cached, self.cache_timeout)
+            df, digest = cached
+
+            # each format and content encoding is a different representation
+            etag = digest + '-' + dataframe_format(request)
+            etag = quote_etag(etag + '-gzip' if accepts_gzip(request) else etag)
+
+            if etag in parse_etags(request.headers.get('If-None-Match', '')):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                patch_vary_headers(response, ['Accept', 'Accept-Encoding'])
+                return response
+
+            response = dataframe_response(df, 'station_list', request)
+            response['ETag'] = etag
+            return response
         except ValueError as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
         except ValidationError as e:
@@ -251,6 +364,7 @@ class ParseHdrFile(APIView):
 
 class ParseBtlFile(APIView):
 
+    renderer_classes = DATAFRAME_RENDERERS
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
@@ -266,7 +380,7 @@ class ParseBtlFile(APIView):
             btl = BtlFile(buffer=btl_file, parse=True)
             df = btl.to_dataframe()
 
-            return csv_response(df, 'btl.csv')
+            return dataframe_response(df, 'btl', request)
         
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
@@ -274,9 +388,13 @@ class ParseBtlFile(APIView):
 
 class ParseAscFile(APIView):
 
+    renderer_classes = DATAFRAME_RENDERERS
     authentication_classes = [TokenAuthentication]
     permission_classes = [permissions.IsAuthenticated]
 
+    # rows per parsed and streamed chunk
+    chunksize = 50000
+
     def post(self, request):
 
         asc_file = request.FILES.get('asc_file', None)
@@ -284,11 +402,162 @@ class ParseAscFile(APIView):
         if asc_file is None:
             return Response({"error": "No ASC data provided"}, status=status.HTTP_400_BAD_REQUEST)
         
-        # Read input ASC file using pandas
+        # optional depth column derived from pressure, at the latitude of the
+        # cast if given, otherwise from the file's own latitude column
+        depth = request.GET.get('depth', '').lower() in ('1', 'true')
+        latitude = request.GET.get('latitude', None)
+
+        # Read input ASC file using pandas. the format is sniffed from the start
+        # of the file, then the file is read once, a chunk at a time, and streamed
+        # back to the client
         try:
-            buffer = BytesIO(asc_file.read())
-            df = parse_asc(buffer, infer_delimiter=True)
-            return csv_response(df, 'asc.csv')
+            if latitude is not None:
+                latitude = float(latitude)
+            chunks = parse_asc(asc_file, infer_delimiter=True, latitude=latitude, depth=depth,
+                               chunksize=self.chunksize)
+            # parse the first chunk now, so that format errors are reported as such
+            first = next(chunks, None)
+            if first is None:
+                return Response({"error": "No ASC data rows found"}, status=status.HTTP_400_BAD_REQUEST)
+            return dataframe_response(itertools.chain([first], chunks), 'asc', request)
         
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+# compile the CTD files of a cruise directory on the data volume. this parses
+# every file in the cruise, so it runs as a job (see SubmitJob) whose result is
+# the requested output
+
+class CompileCruise(APIView):
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    outputs = ['bottles', 'casts', 'timings']
+
+    def post(self, request):
+        directory = request.GET.get('directory', None)
+        output = request.GET.get('output', 'bottles')
+
+        if directory is None:
+            return Response({"error": "No directory provided"}, status=status.HTTP_400_BAD_REQUEST)
+        if output not in self.outputs:
+            return Response({"error": f"output must be one of {', '.join(self.outputs)}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        # the directory is relative to the data volume, and must stay inside it
+        data_dir = os.path.realpath(settings.NESLTER_DATA_DIR)
+        cruise_dir = os.path.realpath(os.path.join(data_dir, directory))
+        if os.path.commonpath([data_dir, cruise_dir]) != data_dir or not os.path.isdir(cruise_dir):
+            return Response({"error": f"No such directory: {directory}"}, status=status.HTTP_404_NOT_FOUND)
+
+        params = { 'directory': os.path.relpath(cruise_dir, data_dir), 'output': output }
+        try:
+            job = jobs.submit_job('compile-cruise', params=params, owner=request.user.pk)
+        except OSError as e: # the jobs volume is missing, full or not writable
+            return Response({"error": f"Unable to queue job: {e.strerror}"},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return Response(job_status_response(request, job), status=status.HTTP_202_ACCEPTED)
+
+
+# asynchronous versions of the enrichment and parsing endpoints. a job is
+# submitted with the same file and query parameters as the synchronous
+# endpoint, and its status and result are fetched using the job id
+
+class SubmitJob(APIView):
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    # file field and accepted query parameters for each kind of job
+    job_inputs = {
+        'add-nearest-stations': ('csv_file', ['timestamp_column', 'latitude_column', 'longitude_column']),
+        'parse-ctd-btl': ('btl_file', []),
+        'parse-ctd-asc': ('asc_file', ['latitude', 'depth']),
+    }
+
+    def post(self, request, kind):
+        if kind not in self.job_inputs:
+            return Response({"error": f"Unknown job type: {kind}"}, status=status.HTTP_404_NOT_FOUND)
+        field, param_names = self.job_inputs[kind]
+
+        input_file = request.FILES.get(field, None)
+        if input_file is None:
+            return Response({"error": f"No file called '{field}'"}, status=status.HTTP_400_BAD_REQUEST)
+
+        params = {name: request.GET[name] for name in param_names if name in request.GET}
+        try:
+            if 'latitude' in params:
+                float(params['latitude'])
+            job = jobs.submit_job(kind, input_file, params=params, owner=request.user.pk)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except OSError as e: # the jobs volume is missing, full or not writable
+            return Response({"error": f"Unable to queue job: {e.strerror}"},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        return Response(job_status_response(request, job), status=status.HTTP_202_ACCEPTED)
+
+
+def job_status_response(request, job):
+    job = {k: v for k, v in job.items() if k not in ('input', 'owner', 'host', 'pid')}
+    job['status_url'] = request.build_absolute_uri(reverse('job-status', args=[job['id']]))
+    if job['status'] == jobs.FINISHED:
+        job['result_url'] = request.build_absolute_uri(reverse('job-result', args=[job['id']]))
+    return job
+
+
+def get_own_job(request, job_id):
+    """the status of a job submitted by the requesting user (or any job, for staff)"""
+    try:
+        job = jobs.job_status(job_id)
+    except jobs.JobNotFound:
+        raise Http404('No such job')
+    if job.get('owner') != request.user.pk and not request.user.is_staff:
+        raise Http404('No such job')
+    return job
+
+
+class JobStatus(APIView):
+
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, job_id):
+        return Response(job_status_response(request, get_own_job(request, job_id)))
+
+
+class JobResult(APIView):
+
+    renderer_classes = DATAFRAME_RENDERERS
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request, job_id):
+        import pyarrow.parquet as pq
+
+        job = get_own_job(request, job_id)
+        try:
+            path = jobs.result_path(job_id)
+        except ValueError as e:
+            return Response({"error": str(e)}, status=status.HTTP_409_CONFLICT)
+
+        basename = job['kind'].replace('-', '_')
+        output_format = dataframe_format(request)
+        if output_format == 'parquet': # already in the requested format
+            return FileResponse(open(path, 'rb'), as_attachment=True, filename=f'{basename}.parquet',
+                                content_type=DATAFRAME_FORMATS['parquet'])
+
+        # convert a batch of rows at a time
+        batches = pq.ParquetFile(path).iter_batches()
+        return dataframe_response((batch.to_pandas() for batch in batches), basename, request)
+
+
+# operational metrics in the Prometheus text format (see api.metrics)
+
+class Metrics(APIView):
+
+    def get(self, request):
+        body, content_type = exposition()
+        return HttpResponse(body, content_type=content_type)
@@ -1,9 +1,19 @@
 # workflows for processing, modifying, and producing data
 
+import numpy as np
 import pandas as pd
 
+from django.contrib.contenttypes.models import ContentType
+from django.contrib.gis.geos import Point
+from django.db import transaction
+from django.utils import timezone
+
 from api.utils import regularize_column_names
-from api.models import Station
+from api.models import Station, StationLocation, Latitude, Longitude
+from api.geo import validate_points, to_utc_datetimes
+from api.index import assign_nearest_stations, location_index, invalidate_location_index, nearest_memo
+from api.instrumentation import stage, timed
+from api.metrics import count_rows_enriched
 
 
 def add_nearest_station(input_df, timestamp_column=None, latitude_column=None, longitude_column=None):
@@ -22,20 +32,16 @@ def add_nearest_station(input_df, timestamp_column=None, latitude_column=None, l
     if 'nearest_station' in df.columns or 'distance_km' in df.columns:
         raise ValueError('Cannot overwrite existing columns: nearest_station, distance_km')
 
-    for index, row in df.iterrows():
-        # check lat/lon for out of range values
-        if row['latitude'] < -90 or row['latitude'] > 90:
-            raise ValueError(f'Invalid latitude value: {row["latitude"]}')
-        if row['longitude'] < -180 or row['longitude'] > 180:
-            raise ValueError(f'Invalid longitude value: {row["longitude"]}')
-        # check for invalid timestamp
-        if pd.isnull(row['timestamp']):
-            raise ValueError('Invalid timestamp value: null')
-        # get the nearest station
-        nearest_location = Station.nearest_location(row['latitude'], row['longitude'], row['timestamp'])
-        # add the station's id to the row
-        df.at[index, 'nearest_station'] = nearest_location.get_station().name
-        df.at[index, 'distance_km'] = nearest_location.distance.m / 1000 # convert to km
+    # check lat/lon/time for out of range or missing values
+    with stage('validate', rows=len(df)):
+        latitudes, longitudes, times = validate_points(df['latitude'], df['longitude'], df['timestamp'])
+
+    # assign the nearest station to all rows at once using the in-memory location index and memo
+    with stage('nearest', rows=len(df)):
+        stations, distance_m = assign_nearest_stations(location_index(), latitudes, longitudes, times, nearest_memo())
+    df['nearest_station'] = stations
+    df['distance_km'] = distance_m / 1000 # convert to km
+    count_rows_enriched(len(df))
 
     # use original column names for existing columns
     df.columns = list(input_df.columns) + ['nearest_station', 'distance_km']
@@ -43,18 +49,67 @@ def add_nearest_station(input_df, timestamp_column=None, latitude_column=None, l
     return df
 
 
+# upper bound on k in nearest_stations, which returns k matches per point
+MAX_NEAREST_K = 10
+
+
+def nearest_stations(points, k=1):
+    """the k nearest stations to each of a list of points, each a dict with latitude,
+    longitude, and (optionally) timestamp keys. points without a timestamp use the
+    current time. returns one dict per point, with its matches ordered by distance"""
+    if k < 1 or k > MAX_NEAREST_K:
+        raise ValueError(f'k must be between 1 and {MAX_NEAREST_K}')
+
+    df = pd.DataFrame.from_records(points, columns=['latitude', 'longitude', 'timestamp'])
+    if df[['latitude', 'longitude']].isnull().any().any():
+        raise ValueError('Latitude and longitude are required.')
+    df['timestamp'] = df['timestamp'].replace('', None).fillna(timezone.now().isoformat())
+    try:
+        df[['latitude', 'longitude']] = df[['latitude', 'longitude']].astype(float)
+    except (ValueError, TypeError) as e:
+        raise ValueError(str(e))
+
+    with stage('validate', rows=len(df)):
+        latitudes, longitudes, times = validate_points(df['latitude'], df['longitude'], df['timestamp'])
+
+    index = location_index()
+    with stage('nearest', rows=len(df)):
+        ix, distance_m = index.nearest(latitudes, longitudes, times, k=k)
+    ix, distance_m = ix.reshape(len(df), k), distance_m.reshape(len(df), k)
+
+    # serialize each matched location once, in the same shape as StationLocationWithDistanceSerializer
+    serialized = {}
+    for i in np.unique(ix[ix >= 0]):
+        loc = index.locations.iloc[i]
+        serialized[i] = {
+            'id': int(loc['id']),
+            'station': { 'id': int(loc['station_id']), 'name': loc['station'] },
+            'geolocation': { 'latitude': loc['latitude'], 'longitude': loc['longitude'] },
+            'depth': None if pd.isnull(loc['depth']) else loc['depth'],
+            'start_time': str(loc['start_time']),
+            'end_time': None if pd.isnull(loc['end_time']) else str(loc['end_time']),
+            'comment': None if pd.isnull(loc['comment']) else loc['comment']
+        }
+
+    results = []
+    for latitude, longitude, time, point_ix, point_distance_m in zip(latitudes, longitudes, times, ix, distance_m):
+        results.append({
+            'latitude': latitude,
+            'longitude': longitude,
+            'timestamp': str(pd.Timestamp(time, tz='UTC')),
+            'nearest': [dict(serialized[i], distance=d / 1000) # convert to km
+                        for i, d in zip(point_ix, point_distance_m) if i >= 0]
+        })
+    return results
+
+
+@timed('station_list', rows=len)
 def station_list(timestamp=None):
-    # get the current location of each Station
-    stations = Station.objects.all()
-    station_locations = [station.get_location(timestamp) for station in stations]
+    # get the location of each Station at the given time in one query
+    rows = Station.locations_at(timestamp).values_list('station__name',
+        Latitude('geolocation'), Longitude('geolocation'), 'depth', 'comment')
     # format as a DataFrame with station name, lat, lon, depth, and comment
-    df = pd.DataFrame.from_records([{
-        'station': station.name,
-        'latitude': location.geolocation.y,
-        'longitude': location.geolocation.x,
-        'depth_m': location.depth,
-        'comment': location.comment
-    } for station, location in zip(stations, station_locations) if location is not None])
+    df = pd.DataFrame.from_records(list(rows), columns=['station', 'latitude', 'longitude', 'depth_m', 'comment'])
     if df.empty:
         return df
     # sort by station name
@@ -63,3 +118,140 @@ def station_list(timestamp=None):
     df.reset_index(drop=True, inplace=True)
     # return the DataFrame
     return df
+
+
+def _parse_station_list_times(s, column):
+    times = to_utc_datetimes(s, errors='coerce')
+    bad = times.isnull() & s.notnull()
+    if bad.any():
+        raise ValueError(f'Invalid {column} value: {s[bad].iloc[0]}')
+    return times
+
+
+def station_list_locations(df):
+    """validate a station list (columns station, decimalLatitude, decimalLongitude,
+    depth_m, startDate, endDate, comment) and chain each station's locations into
+    intervals the way Station.set_location does when they are added in start_time
+    order: a location without an end_time ends where the next one starts.
+
+    returns a DataFrame with columns station, latitude, longitude, depth, start_time,
+    end_time, comment sorted by station and start_time"""
+    df = df.copy()
+    # If the dates are "current", set to null
+    df['startDate'] = np.where(df['startDate'] == 'current', None, df['startDate'])
+    df['endDate'] = np.where(df['endDate'] == 'current', None, df['endDate'])
+    df = df.dropna(subset=['startDate'])
+    df['comment'] = df['comment'].fillna('')
+
+    locations = pd.DataFrame({
+        'station': df['station'].to_numpy(),
+        'latitude': df['decimalLatitude'].astype(float).to_numpy(),
+        'longitude': df['decimalLongitude'].astype(float).to_numpy(),
+        'depth': df['depth_m'].astype(float).to_numpy(),
+        'start_time': _parse_station_list_times(df['startDate'].reset_index(drop=True), 'startDate'),
+        'end_time': _parse_station_list_times(df['endDate'].reset_index(drop=True), 'endDate'),
+        'comment': df['comment'].replace('', None).to_numpy(),
+    })
+
+    # check if lat/lon are valid
+    bad = ~(locations['latitude'].between(-90, 90) & locations['longitude'].between(-180, 180))
+    if bad.any():
+        row = locations[bad].iloc[0]
+        raise ValueError(f"Invalid latitude/longitude for station {row['station']}: {row['latitude']}, {row['longitude']}")
+
+    # check if depth is positive
+    bad = locations['depth'] < 0
+    if bad.any():
+        row = locations[bad].iloc[0]
+        raise ValueError(f"Negative depth for station {row['station']}: {row['depth']}")
+
+    # same checks as Station.set_location
+    if (locations['end_time'] == locations['start_time']).any():
+        raise ValueError('start and end time must not be identical')
+    if (locations['end_time'] < locations['start_time']).any():
+        raise ValueError('end_time must be greater than or equal to start_time')
+    if locations.duplicated(['station', 'start_time']).any():
+        raise ValueError('A location already exists at the given start_time')
+
+    # open intervals end at the start_time of the station's next location
+    locations = locations.sort_values(['station', 'start_time'], kind='stable').reset_index(drop=True)
+    next_start = locations.groupby('station')['start_time'].shift(-1)
+    if (locations['end_time'] > next_start).any():
+        raise ValueError('end_time must be less than or equal to the start_time of the successor location')
+    locations['end_time'] = locations['end_time'].fillna(next_start)
+
+    return locations
+
+
+def _location_tuples(locations):
+    # comparable representation of a station's locations
+    return [tuple(None if pd.isnull(v) else v for v in row)
+            for row in locations[['latitude', 'longitude', 'depth', 'start_time', 'end_time', 'comment']].itertuples(index=False)]
+
+
+def import_station_list(df, update=False):
+    """replace the station list with the contents of a station list DataFrame
+    (see station_list_locations), using bulk inserts.
+
+    if update is True, only stations whose locations differ from what is stored
+    are rewritten, new stations are added, and stations not in the list are left alone.
+    stations listed only on rows without a startDate are kept with no locations.
+    returns a dict of counts of created, updated and unchanged stations"""
+    locations = station_list_locations(df)
+    names = pd.unique(pd.concat([locations['station'], df['station'].dropna()]))
+    content_type = ContentType.objects.get_for_model(Station)
+    counts = { 'created': 0, 'updated': 0, 'unchanged': 0 }
+
+    with transaction.atomic():
+        if update:
+            stations = { s.name: s for s in Station.objects.filter(name__in=names) }
+            existing = pd.DataFrame.from_records(list(StationLocation.objects.filter(
+                content_type=content_type, object_id__in=[s.pk for s in stations.values()]
+            ).order_by('start_time').values_list('object_id', Latitude('geolocation'), Longitude('geolocation'),
+                'depth', 'start_time', 'end_time', 'comment')),
+                columns=['station_id', 'latitude', 'longitude', 'depth', 'start_time', 'end_time', 'comment'])
+            existing['start_time'] = pd.to_datetime(existing['start_time'], utc=True)
+            existing['end_time'] = pd.to_datetime(existing['end_time'], utc=True)
+            existing = dict(list(existing.groupby('station_id')))
+        else:
+            # empty database
+            Station.objects.all().delete()
+            stations, existing = {}, {}
+
+        new_stations = [Station(name=name) for name in names if name not in stations]
+        for station in Station.objects.bulk_create(new_stations):
+            stations[station.name] = station
+        counts['created'] = len(new_stations)
+        new_names = { station.name for station in new_stations }
+
+        # only rewrite the locations of stations that changed
+        changed = []
+        by_station = dict(list(locations.groupby('station', sort=False)))
+        for name in names:
+            sdf = by_station.get(name, locations.iloc[:0])
+            current = existing.get(stations[name].pk, locations.iloc[:0])
+            if name in new_names:
+                changed.append(name)
+            elif _location_tuples(current) != _location_tuples(sdf):
+                changed.append(name)
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+
+        StationLocation.objects.filter(content_type=content_type,
+            object_id__in=[stations[name].pk for name in changed]).delete()
+
+        rows = locations[locations['station'].isin(changed)]
+        StationLocation.objects.bulk_create([StationLocation(
+            content_type=content_type,
+            object_id=stations[row.station].pk,
+            geolocation=Point(row.longitude, row.latitude, srid=4326),
+            depth=None if pd.isnull(row.depth) else row.depth,
+            start_time=row.start_time,
+            end_time=None if pd.isnull(row.end_time) else row.end_time,
+            comment=None if pd.isnull(row.comment) else row.comment
+        ) for row in rows.itertuples()], batch_size=1000)
+
+        invalidate_location_index()
+
+    return counts
@@ -0,0 +1 @@
+# benchmarks for the parsers and geospatial lookups. see README.md
@@ -0,0 +1,316 @@
+# benchmark the geospatial hot paths (nearest station, station location,
+# nearest-station enrichment and station list) on a seeded station history.
+#
+# engines run the same workload on the same data:
+#   memory  the in-memory location index and memo (no database)
+#   brute   vectorized brute force over all locations (no database)
+#   db      the Django models and workflows against PostGIS. a test database is
+#           created from the configured one (e.g. the docker-compose postgres
+#           service) and seeded with import_station_list
+#
+# from the web directory:
+#
+#   python -m benchmarks.geospatial --engine memory --sizes 1,1000,1000000
+#   DJANGO_SETTINGS_MODULE=web.settings python -m benchmarks.geospatial --engine db
+
+import argparse
+import contextlib
+import math
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import harness
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'geospatial_baseline.json')
+
+# the NES-LTER transect region
+LATITUDE_RANGE = (39.7, 41.5)
+LONGITUDE_RANGE = (-71.6, -70.4)
+
+HISTORY_START = pd.Timestamp('2015-01-01', tz='UTC')
+HISTORY_END = pd.Timestamp('2025-01-01', tz='UTC')
+
+
+def station_history(n_stations=50, n_intervals=5, seed=0):
+    """a station catalog of n_stations stations, each with n_intervals consecutive
+    locations (the station moving a little each time), in the form returned by
+    Station.location_frame. each station's last location is open-ended"""
+    rng = np.random.default_rng(seed)
+    span = (HISTORY_END - HISTORY_START).value
+    rows = []
+    for s in range(n_stations):
+        base_lat = rng.uniform(*LATITUDE_RANGE)
+        base_lon = rng.uniform(*LONGITUDE_RANGE)
+        starts = np.sort(rng.integers(0, span, n_intervals - 1)) if n_intervals > 1 else []
+        starts = [HISTORY_START] + [HISTORY_START + pd.Timedelta(int(t), 'ns') for t in starts]
+        for i, start in enumerate(starts):
+            rows.append({
+                'station_id': s + 1,
+                'station': f'L{s + 1}',
+                'latitude': round(base_lat + rng.normal(0, 0.005), 6),
+                'longitude': round(base_lon + rng.normal(0, 0.005), 6),
+                'depth': round(rng.uniform(20, 200), 1),
+                'start_time': start.floor('s'),
+                'end_time': starts[i + 1].floor('s') if i + 1 < len(starts) else pd.NaT,
+                'comment': '',
+            })
+    df = pd.DataFrame(rows)
+    df.insert(0, 'id', np.arange(1, len(df) + 1))
+    return df
+
+
+def to_station_list(history):
+    """the history in the station list format read by import_station_list.
+    end dates are left out, so each location ends where the next one starts"""
+    return pd.DataFrame({
+        'station': history['station'],
+        'decimalLatitude': history['latitude'],
+        'decimalLongitude': history['longitude'],
+        'depth_m': history['depth'],
+        'startDate': history['start_time'].dt.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'endDate': None,
+        'comment': history['comment'],
+    })
+
+
+def query_points(n, history, seed=0, repeat=24):
+    """n query points near the stations, at times within the history. positions
+    come in runs of repeat identical rows, like the bottles of a cast"""
+    rng = np.random.default_rng(seed + 1)
+    n_positions = max(1, math.ceil(n / repeat))
+    near = history.sample(n_positions, replace=True, random_state=seed)
+    latitudes = near['latitude'].to_numpy() + rng.normal(0, 0.05, n_positions)
+    longitudes = near['longitude'].to_numpy() + rng.normal(0, 0.05, n_positions)
+    span = (HISTORY_END - HISTORY_START).value
+    times = HISTORY_START.value + rng.integers(0, span, n_positions)
+    ix = np.repeat(np.arange(n_positions), repeat)[:n]
+    return pd.DataFrame({
+        'latitude': latitudes[ix],
+        'longitude': longitudes[ix],
+        'timestamp': pd.to_datetime(times[ix], utc=True),
+    })
+
+
+class MemoryEngine(object):
+    """the in-memory LocationIndex and NearestMemo, on a history DataFrame"""
+    name = 'memory'
+
+    def __init__(self, history, memo=True):
+        from api.index import LocationIndex, NearestMemo
+        self.history = history
+        self.index = LocationIndex(history)
+        self.index.version = 0
+        self.memo = NearestMemo() if memo else None
+        self._by_station = { name: df.sort_values('start_time') for name, df in history.groupby('station') }
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def capture_queries(self):
+        return contextlib.nullcontext() # no database
+
+    def _nearest(self, latitudes, longitudes, times):
+        from api.index import assign_nearest_stations
+        return assign_nearest_stations(self.index, latitudes, longitudes, times, self.memo)
+
+    def nearest_location(self, latitude, longitude, timestamp):
+        from api.geo import validate_points
+        lat, lon, t = validate_points([latitude], [longitude], [timestamp])
+        stations, distance_m = self._nearest(lat, lon, t)
+        return stations[0], distance_m[0]
+
+    def get_location(self, station, timestamp):
+        df = self._by_station[station]
+        valid = (df['start_time'] <= timestamp) & ((df['end_time'] >= timestamp) | df['end_time'].isnull())
+        valid = df[valid]
+        return valid.iloc[-1] if len(valid) else None
+
+    def add_nearest_station(self, points):
+        from api.geo import validate_points
+        lat, lon, t = validate_points(points['latitude'], points['longitude'], points['timestamp'])
+        stations, distance_m = self._nearest(lat, lon, t)
+        return points.assign(nearest_station=stations, distance_km=distance_m / 1000)
+
+    def station_list(self, timestamp):
+        df = self.history
+        valid = df[(df['start_time'] <= timestamp) & ((df['end_time'] >= timestamp) | df['end_time'].isnull())]
+        valid = valid.sort_values('start_time').drop_duplicates('station', keep='last')
+        return valid.sort_values('station').reset_index(drop=True)
+
+
+class BruteForceEngine(MemoryEngine):
+    """vectorized brute force over every location, without an index or memo"""
+    name = 'brute'
+
+    def __init__(self, history):
+        super(BruteForceEngine, self).__init__(history, memo=False)
+
+    def _nearest(self, latitudes, longitudes, times):
+        from api.geo import nearest_locations
+        ix, distance_m = nearest_locations(latitudes, longitudes, times, self.history)
+        found = ix >= 0
+        stations = np.full(len(ix), None, dtype=object)
+        stations[found] = self.history['station'].to_numpy(dtype=object)[ix[found]]
+        return stations, distance_m
+
+
+class DatabaseEngine(object):
+    """the Django models and workflows, on a test database seeded with the history"""
+    name = 'db'
+
+    def __init__(self, history, keepdb=False):
+        import django
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
+        django.setup()
+        self.history = history
+        self.keepdb = keepdb
+
+    def setup(self):
+        from django.db import connection
+        from django.test.utils import setup_test_environment
+        from api.models import Station
+        from api.workflows import import_station_list
+
+        setup_test_environment()
+        self._old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, keepdb=self.keepdb)
+        import_station_list(to_station_list(self.history))
+        self.stations = { s.name: s for s in Station.objects.all() }
+
+    def teardown(self):
+        from django.db import connection
+        from django.test.utils import teardown_test_environment
+        connection.creation.destroy_test_db(self._old_name, verbosity=0, keepdb=self.keepdb)
+        teardown_test_environment()
+
+    def capture_queries(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        return CaptureQueriesContext(connection)
+
+    def nearest_location(self, latitude, longitude, timestamp):
+        from api.models import Station
+        return Station.nearest_location(latitude, longitude, timestamp)
+
+    def get_location(self, station, timestamp):
+        return self.stations[station].get_location(timestamp)
+
+    def add_nearest_station(self, points):
+        from api.workflows import add_nearest_station
+        return add_nearest_station(points)
+
+    def station_list(self, timestamp):
+        from api.workflows import station_list
+        return station_list(timestamp)
+
+
+ENGINES = {
+    'memory': MemoryEngine,
+    'brute': BruteForceEngine,
+    'db': DatabaseEngine,
+}
+
+
+def latency_summary(seconds, rows_per_call=1):
+    ms = np.asarray(seconds) * 1000
+    total = float(np.sum(seconds))
+    return {
+        'calls': len(ms),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+        'rows_per_sec': len(ms) * rows_per_call / total if total > 0 else None,
+    }
+
+
+def timed_calls(engine, fn, args_list):
+    """call fn once per argument tuple, timing each call. returns the times and
+    the mean number of queries per call (None without a database)"""
+    seconds = []
+    queries = []
+    for args in args_list:
+        with engine.capture_queries() as captured:
+            start = time.perf_counter()
+            fn(*args)
+            seconds.append(time.perf_counter() - start)
+        if captured is not None:
+            queries.append(len(captured))
+    return seconds, (float(np.mean(queries)) if queries else None)
+
+
+def run_workload(engine, history, sizes, n_single=1000, repeat=5, seed=0, out=print):
+    rng = np.random.default_rng(seed + 2)
+    results = {}
+
+    def record(name, seconds, queries, rows_per_call=1):
+        result = latency_summary(seconds, rows_per_call)
+        result['queries_per_call'] = queries
+        results[name] = result
+        text = (f"{name:<34} p50 {result['p50_ms']:9.3f} ms  p90 {result['p90_ms']:9.3f} ms  "
+                f"p99 {result['p99_ms']:9.3f} ms")
+        if queries is not None:
+            text += f"  {queries:6.2f} queries/call"
+        out(text)
+
+    # single point operations, each on a different random point or station
+    points = query_points(n_single, history, seed=seed, repeat=1)
+    args = list(zip(points['latitude'], points['longitude'], points['timestamp']))
+    record('nearest_location', *timed_calls(engine, engine.nearest_location, args))
+    # the same points again, as when a file of casts repeats positions
+    record('nearest_location[repeated]', *timed_calls(engine, engine.nearest_location, args))
+
+    stations = rng.choice(history['station'].unique(), n_single)
+    args = list(zip(stations, points['timestamp']))
+    record('get_location', *timed_calls(engine, engine.get_location, args))
+
+    args = [(t,) for t in points['timestamp'][:max(1, n_single // 10)]]
+    record('station_list', *timed_calls(engine, engine.station_list, args))
+
+    # batch enrichment at each size
+    for size in sizes:
+        batch = query_points(size, history, seed=seed)
+        seconds, queries = timed_calls(engine, engine.add_nearest_station, [(batch,)] * repeat)
+        record(f'add_nearest_station[{size}]', seconds, queries, rows_per_call=size)
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='geospatial benchmarks')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='memory')
+    parser.add_argument('--stations', type=int, default=50, help='number of stations')
+    parser.add_argument('--intervals', type=int, default=5, help='historical locations per station')
+    parser.add_argument('--sizes', type=str, default='1,100,10000,1000000',
+                        help='comma separated numbers of points for add_nearest_station')
+    parser.add_argument('--single', type=int, default=1000, help='calls of each single point operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keepdb', action='store_true', default=False, help='keep the test database (db engine)')
+    harness.add_arguments(parser, DEFAULT_BASELINE)
+    args = parser.parse_args(argv)
+
+    history = station_history(args.stations, args.intervals, seed=args.seed)
+    engine = ENGINES[args.engine](history, keepdb=args.keepdb) if args.engine == 'db' else ENGINES[args.engine](history)
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+
+    engine.setup()
+    try:
+        results = run_workload(engine, history, sizes, n_single=args.single, repeat=args.repeat, seed=args.seed)
+    finally:
+        engine.teardown()
+
+    if args.filter:
+        results = { k: v for k, v in results.items() if args.filter in k }
+    return harness.finish({ f'{args.engine}:{k}': v for k, v in results.items() }, args,
+                          engine=args.engine, stations=args.stations, intervals=args.intervals, sizes=sizes)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
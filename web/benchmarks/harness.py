@@ -0,0 +1,140 @@
+# timing, memory measurement and baseline comparison shared by the benchmarks
+
+import gc
+import json
+import platform
+import time
+import tracemalloc
+
+# a result is a regression if it is this much worse than the baseline
+DEFAULT_TOLERANCE = 0.25
+
+
+class Case(object):
+    """a benchmark case: fn() does the work once and returns the number of
+    rows (or items) it processed"""
+
+    def __init__(self, name, fn, setup=None):
+        self.name = name
+        self.fn = fn
+        self.setup = setup
+
+
+def measure(case, repeat=5, memory=True):
+    """run a case repeat times and return the best time, rows per second and
+    (measured on a separate run, since tracing slows things down) the peak
+    memory allocated by Python and numpy while it ran"""
+    if case.setup is not None:
+        case.setup()
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        rows = case.fn()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    result = {
+        'rows': rows,
+        'seconds': best,
+        'median_seconds': sorted(times)[len(times) // 2],
+        'rows_per_sec': rows / best if best > 0 else None,
+    }
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            case.fn()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def run(cases, repeat=5, memory=True, out=print):
+    results = {}
+    for case in cases:
+        result = measure(case, repeat=repeat, memory=memory)
+        results[case.name] = result
+        out(format_result(case.name, result))
+    return results
+
+
+def format_result(name, result):
+    text = f"{name:<40} {result['seconds'] * 1000:10.2f} ms"
+    if result.get('rows_per_sec') is not None:
+        text += f" {result['rows_per_sec']:14,.0f} rows/s"
+    if result.get('peak_bytes') is not None:
+        text += f" {result['peak_bytes'] / 2**20:10.2f} MiB peak"
+    return text
+
+
+def save_baseline(path, results, **metadata):
+    baseline = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    baseline.update(metadata)
+    with open(path, 'w') as fout:
+        json.dump(baseline, fout, indent=2, sort_keys=True)
+
+
+def load_baseline(path):
+    with open(path) as fin:
+        return json.load(fin)['results']
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """regressions of results against a baseline: throughput lower, or peak
+    memory higher, by more than tolerance (a fraction). returns a list of messages"""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result.get('rows_per_sec') and base.get('rows_per_sec'):
+            if result['rows_per_sec'] < base['rows_per_sec'] * (1 - tolerance):
+                regressions.append(f"{name}: {result['rows_per_sec']:,.0f} rows/s, "
+                                   f"baseline {base['rows_per_sec']:,.0f} rows/s")
+        if result.get('peak_bytes') and base.get('peak_bytes'):
+            if result['peak_bytes'] > base['peak_bytes'] * (1 + tolerance):
+                regressions.append(f"{name}: {result['peak_bytes'] / 2**20:.2f} MiB peak, "
+                                   f"baseline {base['peak_bytes'] / 2**20:.2f} MiB")
+    return regressions
+
+
+def add_arguments(parser, default_baseline):
+    parser.add_argument('--repeat', type=int, default=5, help='runs per case; the best time is reported')
+    parser.add_argument('--no-memory', action='store_true', default=False, help='skip peak memory measurement')
+    parser.add_argument('--baseline', type=str, default=default_baseline, help='baseline JSON file')
+    parser.add_argument('--save', action='store_true', default=False, help='write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='fraction by which a result may be worse than the baseline')
+    parser.add_argument('--filter', type=str, default=None, help='only run cases whose name contains this')
+
+
+def select(cases, args):
+    if args.filter:
+        cases = [c for c in cases if args.filter in c.name]
+    return cases
+
+
+def finish(results, args, **metadata):
+    """save or compare against the baseline. returns the process exit status:
+    1 if there were regressions"""
+    if args.save:
+        save_baseline(args.baseline, results, **metadata)
+        print(f'baseline written to {args.baseline}')
+        return 0
+    try:
+        baseline = load_baseline(args.baseline)
+    except FileNotFoundError:
+        print(f'no baseline at {args.baseline}; run with --save to create one')
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for message in regressions:
+        print(f'REGRESSION {message}')
+    if not regressions:
+        print(f'no regressions against {args.baseline}')
+    return 1 if regressions else 0
@@ -0,0 +1,86 @@
+# benchmark the CTD file parsers on synthetic Sea-Bird files.
+# needs neither a database nor a network connection. from the web directory:
+#
+#   python -m benchmarks.parsers --save     # record a baseline
+#   python -m benchmarks.parsers            # compare against it
+
+import argparse
+import os
+import sys
+import tempfile
+
+from api.parsers.ctd.asc import parse_asc
+from api.parsers.ctd.btl import BtlFile
+from api.parsers.ctd.hdr import HdrFile
+from api.parsers.utils import clean_column_names, format_dataframe
+
+from benchmarks import harness, seabird
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'parsers_baseline.json')
+
+
+def parser_cases(directory, n_hdr=200, n_bottles=36, n_rows=100000):
+    """write synthetic files to directory and return the benchmark cases"""
+    cases = []
+
+    hdr_paths = [seabird.write_file(os.path.join(directory, f'EN627_{i:03d}_u.hdr'), seabird.make_hdr(cast=i))
+                 for i in range(1, n_hdr + 1)]
+    def parse_hdrs():
+        for path in hdr_paths:
+            HdrFile(path=path)
+        return len(hdr_paths)
+    cases.append(harness.Case(f'hdr[{n_hdr} files]', parse_hdrs))
+
+    for minmax in (False, True):
+        path = seabird.write_file(os.path.join(directory, f'minmax{int(minmax)}.btl'),
+                                  seabird.make_btl(n_bottles, minmax=minmax))
+        def parse_btl(path=path):
+            return len(BtlFile(path=path).to_dataframe())
+        label = 'avg/sdev/min/max' if minmax else 'avg/sdev'
+        cases.append(harness.Case(f'btl[{label}, {n_bottles} bottles]', parse_btl))
+
+    for variant in seabird.ASC_VARIANTS:
+        path = seabird.write_file(os.path.join(directory, f'{variant}.asc'), seabird.make_asc(n_rows, variant))
+        def read(path=path):
+            return len(parse_asc(path, depth=True))
+        cases.append(harness.Case(f'asc[{variant}, {n_rows} rows]', read))
+
+    path = os.path.join(directory, 'csv.asc')
+    def read_chunked():
+        return sum(len(df) for df in parse_asc(path, depth=True, chunksize=10000))
+    cases.append(harness.Case(f'asc[csv chunked, {n_rows} rows]', read_chunked))
+
+    # api.parsers.utils on a frame the size of a parsed ASC file
+    df = seabird.profile(n_rows)
+    def clean():
+        clean_column_names(df)
+        return len(df)
+    cases.append(harness.Case(f'utils.clean_column_names[{n_rows} rows]', clean))
+
+    small = df.iloc[:n_rows // 10]
+    def format_floats():
+        format_dataframe(small, precision={ c: 3 for c in small.columns })
+        return len(small) * len(small.columns)
+    cases.append(harness.Case(f'utils.format_dataframe[{len(small)} rows]', format_floats))
+
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CTD parser benchmarks')
+    parser.add_argument('--hdr-files', type=int, default=200, help='number of .hdr files parsed per run')
+    parser.add_argument('--bottles', type=int, default=36, help='bottles per .btl file')
+    parser.add_argument('--rows', type=int, default=100000, help='rows per .asc file')
+    harness.add_arguments(parser, DEFAULT_BASELINE)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cases = harness.select(parser_cases(directory, args.hdr_files, args.bottles, args.rows), args)
+        results = harness.run(cases, repeat=args.repeat, memory=not args.no_memory)
+
+    return harness.finish(results, args, sizes={
+        'hdr_files': args.hdr_files, 'bottles': args.bottles, 'rows': args.rows })
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# synthetic Sea-Bird CTD files (.hdr, .btl and .asc) for benchmarks.
+# values follow a plausible profile (temperature and oxygen falling with
+# depth, salinity rising) so the files look like the real thing to the parsers
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# variables recorded in the generated files, as (name, definition, units)
+VARIABLES = [
+    ('prDM', 'Pressure, Digiquartz', 'db'),
+    ('depSM', 'Depth', 'salt water, m'),
+    ('t090C', 'Temperature', 'ITS-90, deg C'),
+    ('c0S/m', 'Conductivity', 'S/m'),
+    ('sal00', 'Salinity, Practical', 'PSU'),
+    ('sbeox0V', 'Oxygen raw, SBE 43', 'V'),
+    ('flECO-AFL', 'Fluorescence, WET Labs ECO-AFL/FL', 'mg/m^3'),
+    ('latitude', 'Latitude', 'deg'),
+    ('longitude', 'Longitude', 'deg'),
+]
+
+# column headings used in .btl and .asc files
+BTL_NAMES = ['PrDM', 'DepSM', 'T090C', 'C0S/m', 'Sal00', 'Sbeox0V', 'FlECO-AFL', 'Latitude', 'Longitude']
+
+ASC_VARIANTS = ('csv', 'semicolon', 'fwf')
+
+
+def _lat_lon_text(value, hemispheres):
+    hemi = hemispheres[0] if value >= 0 else hemispheres[1]
+    value = abs(value)
+    deg = int(value)
+    return f'{deg:02d} {(value - deg) * 60:05.2f} {hemi}'
+
+
+def header_lines(cruise='EN627', cast=1, time=None, latitude=41.1920, longitude=-70.8840):
+    """the header block shared by .hdr, .btl and .cnv files"""
+    time = pd.Timestamp('2019-10-21 00:15:01') if time is None else pd.Timestamp(time)
+    stamp = time.strftime('%b %d %Y %H:%M:%S')
+    lines = [
+        '* Sea-Bird SBE 9 Data File:',
+        f'* FileName = C:\\data\\{cruise}\\{cruise}_{cast:03d}.hex',
+        '* Software version 7.26.7.107',
+        f'* NMEA Latitude = {_lat_lon_text(latitude, "NS")}',
+        f'* NMEA Longitude = {_lat_lon_text(longitude, "EW")}',
+        f'* NMEA UTC (Time) = {stamp}',
+        f'* System UTC = {stamp}',
+        f'** Cruise: {cruise}',
+        f'** Cast: {cast:03d}',
+        f'# nquan = {len(VARIABLES)}',
+        '# nvalues = 0',
+    ]
+    for i, (name, definition, units) in enumerate(VARIABLES):
+        lines.append(f'# name {i} = {name}: {definition} [{units}]')
+    lines += [
+        '# interval = seconds: 0.0416667',
+        '# start_time = ' + stamp + ' [NMEA time, header]',
+        '# file_type = ascii',
+    ]
+    return lines
+
+
+def profile(n, max_depth=100.0, latitude=41.192, longitude=-70.884, seed=0):
+    """a DataFrame of n samples down a plausible water column"""
+    rng = np.random.default_rng(seed)
+    depth = np.sort(rng.uniform(1, max_depth, n))
+    frac = depth / max_depth
+    temperature = 18 - 8 * frac + rng.normal(0, 0.05, n)
+    salinity = 31.5 + 2 * frac + rng.normal(0, 0.01, n)
+    return pd.DataFrame({
+        'PrDM': depth * 1.0055,
+        'DepSM': depth,
+        'T090C': temperature,
+        'C0S/m': 3.2 + 0.09 * temperature + rng.normal(0, 0.001, n),
+        'Sal00': salinity,
+        'Sbeox0V': 2.6 - 0.4 * frac + rng.normal(0, 0.01, n),
+        'FlECO-AFL': np.clip(1.5 * np.exp(-((depth - 20) / 10) ** 2) + rng.normal(0, 0.02, n), 0, None),
+        'Latitude': latitude + rng.normal(0, 1e-4, n),
+        'Longitude': longitude + rng.normal(0, 1e-4, n),
+    })
+
+
+def make_hdr(cruise='EN627', cast=1, **kw):
+    return '\n'.join(header_lines(cruise, cast, **kw) + ['*END*']) + '\n'
+
+
+def make_btl(n_bottles=24, minmax=False, cruise='EN627', cast=1, seed=0):
+    """a .btl file of n_bottles bottles. each bottle has an average line and a
+    standard deviation line (which carries the time), plus min and max lines if
+    minmax is True"""
+    df = profile(n_bottles, seed=seed)[::-1] # bottles are fired on the way up
+    start = pd.Timestamp('2019-10-21 00:15:01')
+    lines = header_lines(cruise, cast, time=start) + ['*END*']
+    lines.append('    Bottle        Date' + ''.join(f'{name:>11}' for name in BTL_NAMES))
+    lines.append('  Position        Time')
+    for bottle, (_, row) in enumerate(df.iterrows(), 1):
+        values = row[BTL_NAMES].to_numpy()
+        time = start + pd.Timedelta(seconds=67 * bottle)
+        lines.append(f'{bottle:>7}{time.strftime("%b %d %Y"):>15}' +
+                     ''.join(f'{v:>11.4f}' for v in values) + ' (avg)')
+        lines.append(f'{"":>7}{time.strftime("%H:%M:%S"):>15}' +
+                     ''.join(f'{abs(v) * 1e-4:>11.4f}' for v in values) + ' (sdev)')
+        if minmax:
+            lines.append(f'{"":>22}' + ''.join(f'{v - 0.01:>11.4f}' for v in values) + ' (min)')
+            lines.append(f'{"":>22}' + ''.join(f'{v + 0.01:>11.4f}' for v in values) + ' (max)')
+    return '\n'.join(lines) + '\n'
+
+
+def make_asc(n_rows=10000, variant='csv', seed=0):
+    """an .asc export of n_rows samples: comma or semicolon separated,
+    or fixed-width ('fwf') with 12 character columns"""
+    df = profile(n_rows, seed=seed)
+    names = [n for n in BTL_NAMES if n not in ('DepSM', 'Longitude')]
+    values = df[names].to_numpy()
+    if variant == 'fwf':
+        lines = [''.join(f'{n:>12}' for n in names)]
+        lines += [''.join(f'{v:>12.4f}' for v in row) for row in values]
+    else:
+        sep = ',' if variant == 'csv' else ';'
+        lines = [sep.join(names)]
+        lines += [sep.join(f'{v:.4f}' for v in row) for row in values]
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path, text):
+    # Sea-Bird software writes latin-1 with CRLF line endings
+    with open(path, 'w', encoding='latin-1', newline='\r\n') as fout:
+        fout.write(text)
+    return path
+
+
+def write_cruise(directory, cruise='EN627', n_casts=10, n_bottles=24, n_rows=10000, variant='csv'):
+    """write .hdr, .btl and .asc files for n_casts casts of a cruise, named
+    like EN627_001_u.hdr. returns the paths written"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for cast in range(1, n_casts + 1):
+        base = os.path.join(directory, f'{cruise}_{cast:03d}_u')
+        paths.append(write_file(base + '.hdr', make_hdr(cruise, cast)))
+        paths.append(write_file(base + '.btl', make_btl(n_bottles, cruise=cruise, cast=cast, seed=cast)))
+        paths.append(write_file(base + '.asc', make_asc(n_rows, variant, seed=cast)))
+    return paths
@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'api.middleware.TimingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -139,6 +140,46 @@ REST_FRAMEWORK = {
 }
 
 
+# nearest-station lookups are memoized per worker process (see api.index.NearestMemo)
+# for positions rounded to NESLTER_NEAREST_MEMO_QUANTUM degrees (1e-5 is about 1 m)
+NESLTER_NEAREST_MEMO_SIZE = int(os.getenv('NESLTER_NEAREST_MEMO_SIZE', 100000))
+NESLTER_NEAREST_MEMO_QUANTUM = float(os.getenv('NESLTER_NEAREST_MEMO_QUANTUM', 1e-5))
+
+# mounted data volume. CTD files are read from under it
+NESLTER_DATA_DIR = os.getenv('NESLTER_DATA_DIR', '/data')
+
+# parse cache (see api.parsers.ctd.cache) for cruises compiled through the API.
+# unset, the API parses every file and writes nothing to the data volume
+NESLTER_CTD_CACHE_DIR = os.getenv('NESLTER_CTD_CACHE_DIR') or None
+
+# asynchronous jobs (see api.jobs). inputs and results are kept on the /data
+# volume for NESLTER_JOB_TTL seconds after the job was last updated
+NESLTER_JOBS_DIR = os.getenv('NESLTER_JOBS_DIR', '/data/jobs')
+NESLTER_JOB_TTL = int(os.getenv('NESLTER_JOB_TTL', 7 * 24 * 60 * 60))
+NESLTER_JOB_WORKERS = int(os.getenv('NESLTER_JOB_WORKERS', 2))
+
+# per-request timing (see api.middleware.TimingMiddleware). stage timings are sent
+# in Server-Timing response headers unless NESLTER_SERVER_TIMING is false, and
+# logged as one JSON line per request on the api.timing logger
+NESLTER_SERVER_TIMING = os.getenv('NESLTER_SERVER_TIMING', 'true').lower() in ('true', '1', 'yes')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api.timing': {
+            'handlers': ['console'],
+            'level': os.getenv('NESLTER_TIMING_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 _HOST = os.getenv('DJANGO_HOST', 'localhost')
 _HTTPS_PORT = os.getenv('DJANGO_HTTPS_PORT', '443')
 _HTTP_PORT = os.getenv('DJANGO_HTTP_PORT', '80')